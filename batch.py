@@ -0,0 +1,229 @@
+"""Command line tool for applying filters to many images in parallel.
+
+Example:
+    python batch.py photos/ 'scans/*.png' --filters sepia,lighter:3 --output filtered/
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import cpu_count
+
+from PIL import Image
+
+from cache import CACHE_BUDGET, ResultCache, file_digest, result_key
+from filters import to_filter_mode
+from frames import filter_frames, is_multi_frame
+from history import image_bytes
+from image import PILImage, parse_save_options, save_image
+from pipeline import FilterPipeline
+from streaming import BAND_HEIGHT, open_source, stream_filter
+
+# File extensions picked up when a directory is given as input
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+
+# Default number of megabytes the images being filtered at once may use
+MEMORY_BUDGET = 2048
+
+def find_images(inputs):
+    """Returns the image paths matching a list of files, directories and glob patterns."""
+    image_paths = []
+
+    for pattern in inputs:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if os.path.isdir(path):
+                image_paths.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                    if name.lower().endswith(IMAGE_EXTENSIONS)))
+            elif os.path.isfile(path):
+                image_paths.append(path)
+            else:
+                print(f'No images found at: {path}', file=sys.stderr)
+
+    # Images matched by more than one input are only filtered once
+    return list(dict.fromkeys(image_paths))
+
+def is_up_to_date(image_path, output_path):
+    """Checks if an output exists and is newer than its input."""
+    return os.path.exists(output_path) and \
+        os.path.getmtime(output_path) >= os.path.getmtime(image_path)
+
+def estimate_memory(image_path, band_height=None):
+    """Estimates the number of bytes needed to filter an image, without decoding it."""
+    if band_height is None:
+        # Decoded image and its filtered copy are alive at the same time
+        with Image.open(image_path) as current_image:
+            return image_bytes(current_image) * 2
+
+    # When streaming, only a band and its filtered copy are
+    with open_source(image_path) as current_image:
+        return image_bytes(current_image) * 2 * min(band_height, current_image.height) // \
+            current_image.height
+
+def filter_image(image_path, output_path, pipeline, band_height=None, cache=None,
+        save_options=None):
+    """Applies a pipeline to an image file and saves the result with encoder options.
+
+    Returns the megapixels of the image and whether it was found in the result
+    cache, or None if no cache is used. Images are streamed band by band if a
+    band height is given, streamed images are not cached.
+    """
+    if band_height is not None:
+        return stream_filter(image_path, output_path, pipeline, band_height), None
+
+    # Results are looked up by the bytes of the file, so hits need no decoding
+    if cache is not None:
+        key = result_key(file_digest(image_path), pipeline.steps)
+        new_image = cache.load(key)
+        if new_image is not None:
+            save_image(new_image, output_path, save_options)
+            return new_image.width * new_image.height / 1_000_000, True
+
+    image = PILImage()
+    image.open(image_path)
+
+    # Filters work on RGB and RGBA images, P images are filtered through their palette
+    if image.current.mode != 'P':
+        image.set_image(to_filter_mode(image.current))
+
+    image.apply(pipeline)
+    image.save(output_path, save_options)
+
+    if cache is not None:
+        cache.store(key, image.current)
+
+    return image.current.width * image.current.height / 1_000_000, \
+        None if cache is None else False
+
+def run_batch(jobs, pipeline, workers, memory_budget, band_height=None, cache=None,
+        save_options=None):
+    """Filters (image path, output path) jobs on a process pool, returns counts and megapixels.
+
+    Jobs are only submitted while the estimated memory of the images in flight
+    stays under the budget, one job is always allowed so huge images still run.
+    Images are streamed band by band if a band height is given. Cache hits and
+    misses of the workers are added to the counts of the given result cache.
+    Frames of animations and multi-page images are spread over the pool, they are
+    not streamed or cached.
+    """
+    # Filters reading neighbouring pixels would see the edges of each band
+    if pipeline.radius():
+        band_height = None
+
+    filtered_count = 0
+    failed_count = 0
+    megapixels = 0
+
+    with ProcessPoolExecutor(workers) as pool:
+        in_flight = {}
+
+        def collect(futures):
+            nonlocal filtered_count, failed_count, megapixels
+            for future in futures:
+                image_path, _ = in_flight.pop(future)
+                try:
+                    image_megapixels, cache_hit = future.result()
+                    megapixels += image_megapixels
+                    filtered_count += 1
+                    if cache_hit is not None:
+                        cache.hits += cache_hit
+                        cache.misses += not cache_hit
+                # Decoders and encoders fail with errors of their own, which only
+                # fail their image
+                except Exception as exc:
+                    print(f'Could not filter {image_path}: {exc}', file=sys.stderr)
+                    failed_count += 1
+
+        for image_path, output_path in jobs:
+            try:
+                job_memory = estimate_memory(image_path, band_height)
+
+                # Frames are filtered in order here while other jobs keep running
+                if is_multi_frame(image_path):
+                    megapixels += filter_frames(image_path, output_path, pipeline, pool,
+                        workers, save_options)
+                    filtered_count += 1
+                    continue
+            except Exception as exc:
+                print(f'Could not filter {image_path}: {exc}', file=sys.stderr)
+                failed_count += 1
+                continue
+
+            # Wait for running jobs to finish until this job fits in the budget
+            while in_flight and sum(memory for _, memory in in_flight.values()) + \
+                    job_memory > memory_budget:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            future = pool.submit(filter_image, image_path, output_path, pipeline, band_height,
+                cache, save_options)
+            in_flight[future] = (image_path, job_memory)
+
+        collect(wait(in_flight).done)
+
+    return filtered_count, failed_count, megapixels
+
+def main(arguments=None):
+    """Parses command line arguments and filters the images."""
+    parser = argparse.ArgumentParser(description='Apply filters to many images in parallel.')
+    parser.add_argument('inputs', nargs='+', help='image files, directories or glob patterns')
+    parser.add_argument('-f', '--filters', required=True,
+        help="comma separated filters with optional intensity, e.g. 'sepia,lighter:3'")
+    parser.add_argument('-o', '--output', required=True, help='directory for filtered images')
+    parser.add_argument('-w', '--workers', type=int, default=cpu_count(),
+        help='number of worker processes (default: CPU count)')
+    parser.add_argument('-m', '--memory', type=int, default=MEMORY_BUDGET,
+        help=f'megabytes of images in flight at once (default: {MEMORY_BUDGET})')
+    parser.add_argument('--force', action='store_true',
+        help='filter images even if their output is up to date')
+    parser.add_argument('-s', '--stream', type=int, nargs='?', const=BAND_HEIGHT,
+        metavar='BAND_HEIGHT', help='filter uncompressed images band by band without loading '
+        f'them, saving them as PNG (default band height: {BAND_HEIGHT} rows)')
+    parser.add_argument('-c', '--cache', metavar='DIRECTORY',
+        help='directory for a result cache shared by runs with the same images and filters')
+    parser.add_argument('--cache-size', type=int, default=CACHE_BUDGET // 1024 ** 2,
+        metavar='MB', help='megabytes the result cache may use '
+        f'(default: {CACHE_BUDGET // 1024 ** 2})')
+    parser.add_argument('--save-options', default='',
+        help="comma separated encoder options by format, e.g. 'png.compress_level=1,"
+        "jpeg.quality=85,jpeg.progressive=1,webp.method=6'")
+    arguments = parser.parse_args(arguments)
+
+    try:
+        pipeline = FilterPipeline.parse(arguments.filters)
+        save_options = parse_save_options(arguments.save_options)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    os.makedirs(arguments.output, exist_ok=True)
+    cache = None if arguments.cache is None else \
+        ResultCache(arguments.cache, arguments.cache_size * 1024 ** 2)
+
+    # Outputs keep the file name of their input, streamed outputs are PNG files
+    jobs = []
+    skipped_count = 0
+    for image_path in find_images(arguments.inputs):
+        output_path = os.path.join(arguments.output, os.path.basename(image_path))
+        if arguments.stream:
+            output_path = os.path.splitext(output_path)[0] + '.png'
+        if not arguments.force and is_up_to_date(image_path, output_path):
+            skipped_count += 1
+        else:
+            jobs.append((image_path, output_path))
+
+    start_time = time.perf_counter()
+    filtered_count, failed_count, megapixels = run_batch(jobs, pipeline, arguments.workers,
+        arguments.memory * 1024 ** 2, arguments.stream, cache, save_options)
+    elapsed_time = max(time.perf_counter() - start_time, 1e-9)
+
+    print(f'Filtered {filtered_count} images ({skipped_count} up to date, '
+        f'{failed_count} failed) in {elapsed_time:.2f} s: '
+        f'{filtered_count / elapsed_time:.2f} images/s, {megapixels / elapsed_time:.2f} MP/s')
+    if cache is not None:
+        print(f'Result cache: {cache.hits} hits, {cache.misses} misses')
+
+    return 1 if failed_count else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
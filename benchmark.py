@@ -0,0 +1,289 @@
+"""Benchmark for every filter, image size, image mode and execution path.
+
+Example:
+    python benchmark.py --sizes 0.1,1,24 --output before.json
+    python benchmark.py --sizes 0.1,1,24 --output after.json --compare before.json
+"""
+import argparse
+import json
+import platform
+import resource
+import sys
+import time
+from multiprocessing import Pool, active_children, cpu_count
+
+import numpy as np
+from PIL import Image
+
+import filters
+from filters import to_filter_mode
+from executor import FilterExecutor
+from pipeline import FilterPipeline
+
+# Image sizes in megapixels, generated with a 3:2 aspect ratio
+SIZES = (0.1, 1, 5, 24, 50)
+
+# Execution paths, serial and pool paths run the filters on the named engine,
+# pool:python is the code path of the filter button before the engines were added
+PATHS = ('serial:python', 'serial:numpy', 'serial:lut', 'pool:python', 'pool:numpy',
+    'pool:lut', 'pipeline', 'executor')
+
+# Largest size in megapixels the per-pixel reference loops are timed on
+REFERENCE_MAX = 0.1
+
+# Side of the crops checked against the reference loops
+CHECK_SIDE = 48
+
+def generate_image(megapixels, mode, seed=0):
+    """Generates a noise image of a given size and mode."""
+    width = max(1, round((megapixels * 1_000_000 * 1.5) ** 0.5))
+    height = max(1, round(megapixels * 1_000_000 / width))
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, len(mode)),
+        dtype=np.uint8)
+    return Image.fromarray(pixels)
+
+def worker_pids(excluded=()):
+    """Returns the process ids of the live worker processes of this process, except given ones."""
+    return [process.pid for process in active_children() if process.pid not in excluded]
+
+def reset_peak_memory(pids=()):
+    """Resets the peak resident memory of this process and of given processes,
+    returns False if not supported."""
+    try:
+        for pid in ('self', *pids):
+            with open(f'/proc/{pid}/clear_refs', 'w', encoding='ascii') as clear_refs:
+                clear_refs.write('5')
+    except OSError:
+        return False
+    return True
+
+def process_peak_memory(pid):
+    """Returns the peak resident memory of a process in megabytes, None if not supported."""
+    try:
+        with open(f'/proc/{pid}/status', encoding='ascii') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def peak_memory():
+    """Returns the peak resident memory of this process in megabytes."""
+    peak = process_peak_memory('self')
+    if peak is not None:
+        return peak
+
+    # Peak since the process started, in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def workers_peak_memory(pids):
+    """Returns the peak resident memory of worker processes added up, in megabytes.
+
+    Workers are only counted where their peak can be read from /proc.
+    """
+    return sum(process_peak_memory(pid) or 0 for pid in pids)
+
+def run_serial(current_image, image_filter, intensity, engine):
+    """Applies a filter in this process on an engine."""
+    filters.set_engine(engine)
+    try:
+        return image_filter(current_image, intensity)
+    finally:
+        filters.set_engine('lut')
+
+def run_pool(current_image, image_filter, intensity, engine, workers):
+    """Applies a filter to sections on a new Pool, as the filter button used to.
+
+    Returns the filtered image and the peak memory of the pool workers in megabytes.
+    """
+    # Sections are columns of the width of the image divided by the workers,
+    # the last one also takes the remaining columns
+    count = min(workers, current_image.width)
+    section_width = current_image.width // count
+    boxes = [(section_width * index, 0, section_width * (index + 1), current_image.height)
+        for index in range(count - 1)]
+    boxes.append((section_width * (count - 1), 0, current_image.width, current_image.height))
+
+    other_workers = worker_pids()
+    with Pool(count, initializer=filters.set_engine, initargs=(engine,)) as pool:
+        new_sections = pool.starmap(image_filter,
+            [(current_image.crop(box), intensity) for box in boxes])
+
+        # Workers are stopped with the pool, so their peak memory is read before
+        workers_memory = workers_peak_memory(worker_pids(other_workers))
+
+    new_image = Image.new(current_image.mode, current_image.size)
+    for box, new_section in zip(boxes, new_sections):
+        new_image.paste(new_section, box[:2])
+
+    return new_image, workers_memory
+
+def run_path(path, current_image, image_filter, intensity, workers, executor):
+    """Applies a filter on an execution path.
+
+    Returns the filtered image and the peak memory of the workers it ran on in megabytes.
+    """
+    kind, _, engine = path.partition(':')
+    if kind == 'serial':
+        return run_serial(current_image, image_filter, intensity, engine), 0
+    if kind == 'pool':
+        return run_pool(current_image, image_filter, intensity, engine, workers)
+    if kind == 'pipeline':
+        return FilterPipeline([(image_filter, intensity)]).apply(current_image), 0
+
+    # Only the executor workers are alive outside of run_pool
+    new_image = executor.apply(current_image, image_filter, intensity)
+    return new_image, workers_peak_memory(worker_pids())
+
+def check_output(current_image, new_image, image_filter, intensity):
+    """Checks crops at the corners and center of an output against the reference loops.
+
+    Filters work on single pixels, so filtering a crop equals cropping the filtered image.
+    """
+    width, height = current_image.size
+    side = min(CHECK_SIDE, width, height)
+    corners = ((0, 0), (width - side, 0), ((width - side) // 2, (height - side) // 2),
+        (0, height - side), (width - side, height - side))
+
+    for left, upper in corners:
+        box = (left, upper, left + side, upper + side)
+        expected = run_serial(current_image.crop(box), image_filter, intensity, 'python')
+        if to_filter_mode(new_image.crop(box)).tobytes() != expected.tobytes():
+            return False
+
+    # Gray results may be kept in a single channel
+    return new_image.size == current_image.size and \
+        to_filter_mode(new_image).mode == current_image.mode
+
+def benchmark(sizes, modes, filter_names, paths, workers, repeat, reference_max):
+    """Times every combination, returns a list of result dictionaries."""
+    results = []
+
+    with FilterExecutor(workers) as executor:
+        for megapixels in sizes:
+            for mode in modes:
+                current_image = generate_image(megapixels, mode)
+                current_image.load()
+                print(f'{megapixels} MP {mode} ({current_image.width}x{current_image.height})',
+                    file=sys.stderr)
+
+                for filter_name in filter_names:
+                    image_filter = filters.FILTERS[filter_name]
+
+                    for path in paths:
+                        # Per-pixel loops are too slow for large images
+                        if path.endswith(':python') and megapixels > reference_max:
+                            continue
+
+                        timings = []
+                        workers_memory = 0
+                        reset_peak_memory(worker_pids())
+                        for _ in range(repeat):
+                            start_time = time.perf_counter()
+                            new_image, run_workers_memory = run_path(path, current_image,
+                                image_filter, 1, workers, executor)
+                            timings.append((time.perf_counter() - start_time) * 1000)
+                            workers_memory = max(workers_memory, run_workers_memory)
+
+                        milliseconds = min(timings)
+                        ms_per_mp = milliseconds / (current_image.width *
+                            current_image.height / 1_000_000)
+
+                        results.append({
+                            'filter': filter_name,
+                            'megapixels': megapixels,
+                            'width': current_image.width,
+                            'height': current_image.height,
+                            'mode': mode,
+                            'path': path,
+                            'ms': round(milliseconds, 3),
+                            'ms_per_mp': round(ms_per_mp, 3),
+                            'peak_rss_mb': round(peak_memory() + workers_memory, 1),
+                            'verified': check_output(current_image, new_image, image_filter, 1)
+                        })
+                        print(f'  {filter_name:16} {path:14} {ms_per_mp:10.2f} ms/MP' +
+                            ('' if results[-1]['verified'] else '  OUTPUT DIFFERS'),
+                            file=sys.stderr)
+
+    # Per-pixel loops take the same time per megapixel at any size, so speedups are
+    # over their ms/MP at the largest size they were timed on
+    reference_ms_per_mp = {}
+    for result in sorted(results, key=lambda result: result['megapixels']):
+        if result['path'] == 'serial:python':
+            reference_ms_per_mp[(result['filter'], result['mode'])] = result['ms_per_mp']
+
+    for result in results:
+        reference = reference_ms_per_mp.get((result['filter'], result['mode']))
+        result['speedup'] = round(reference / result['ms_per_mp'], 2) \
+            if reference and result['ms_per_mp'] else None
+
+    return results
+
+def compare(results, old_results):
+    """Prints the change in ms/MP of every combination found in both runs."""
+    def key(result):
+        return (result['filter'], result['megapixels'], result['mode'], result['path'])
+
+    old_timings = {key(result): result['ms_per_mp'] for result in old_results}
+
+    print(f'{"filter":16} {"MP":>6} {"mode":5} {"path":14} {"old":>10} {"new":>10} '
+        f'{"change":>8}')
+    for result in results:
+        old_ms_per_mp = old_timings.get(key(result))
+        if old_ms_per_mp:
+            change = (result['ms_per_mp'] - old_ms_per_mp) / old_ms_per_mp * 100
+            print(f'{result["filter"]:16} {result["megapixels"]:>6} {result["mode"]:5} '
+                f'{result["path"]:14} {old_ms_per_mp:>10.2f} {result["ms_per_mp"]:>10.2f} '
+                f'{change:>+7.1f}%')
+
+def main(arguments=None):
+    """Parses command line arguments and runs the benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark the filters on every path.')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+        help='comma separated image sizes in megapixels')
+    parser.add_argument('--modes', default='RGB,RGBA', help='comma separated image modes')
+    parser.add_argument('--filters', default=','.join(filters.FILTERS),
+        help='comma separated filter names')
+    parser.add_argument('--paths', default=','.join(PATHS),
+        help='comma separated execution paths')
+    parser.add_argument('--workers', type=int, default=cpu_count(),
+        help='number of worker processes (default: CPU count)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per combination, best is kept')
+    parser.add_argument('--reference-max', type=float, default=REFERENCE_MAX,
+        help='largest size in megapixels the per-pixel loops are timed on')
+    parser.add_argument('--output', help='JSON file to write results to')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    arguments = parser.parse_args(arguments)
+
+    results = benchmark([float(size) for size in arguments.sizes.split(',')],
+        arguments.modes.split(','), arguments.filters.split(','), arguments.paths.split(','),
+        arguments.workers, arguments.repeat, arguments.reference_max)
+
+    report = {
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': cpu_count(),
+            'workers': arguments.workers
+        },
+        'results': results
+    }
+
+    if arguments.output:
+        with open(arguments.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if arguments.compare:
+        with open(arguments.compare, encoding='utf-8') as old_output:
+            compare(results, json.load(old_output)['results'])
+
+    # Fails if any path changed the output of a filter
+    return 0 if all(result['verified'] for result in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""This module contains the ResultCache class.
+
+Results are keyed by a digest of their source, either its pixels or its file
+bytes, and the recipe applied to it, so the same source and recipe always find
+the same entry wherever the source is stored.
+"""
+import hashlib
+import os
+import tempfile
+import time
+
+from PIL import Image
+
+from pipeline import FilterPipeline
+from tracing import tracer
+
+# Default number of bytes cached results may use on disk
+CACHE_BUDGET = 1024 * 1024 * 1024
+
+# Version of the filters, changing it makes every cached result stale
+CACHE_VERSION = 1
+
+# Seconds after which a temporary file is left over from a crashed writer
+TEMPORARY_FILE_AGE = 3600
+
+def image_digest(current_image):
+    """Returns a digest of the mode, size and pixels of an image."""
+    digest = hashlib.blake2b(f'{current_image.mode} {current_image.width} '
+        f'{current_image.height}\n'.encode())
+    digest.update(current_image.tobytes())
+    return digest.hexdigest()
+
+def file_digest(path):
+    """Returns a digest of the bytes of a file."""
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def result_key(source_digest, steps):
+    """Returns the key of the result of applying (filter, intensity) steps to a source."""
+    recipe = FilterPipeline(steps).recipe()
+    return hashlib.blake2b(f'{CACHE_VERSION}\n{source_digest}\n{recipe}'.encode(),
+        digest_size=20).hexdigest()
+
+class ResultCache:
+    """This class contains filtered images stored in a directory, evicting the least
+    recently used ones when they use more than the budget.
+
+    Several processes can use the same directory. Entries are written to a
+    temporary file and renamed into place, so readers never see partial entries,
+    and entries removed by another process are treated as misses.
+    """
+    def __init__(self, directory, budget=CACHE_BUDGET):
+        self.directory = directory
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """Returns the path of the entry with a key."""
+        return os.path.join(self.directory, f'{key}.img')
+
+    def load(self, key):
+        """Returns the image stored with a key, or None."""
+        path = self.path(key)
+
+        # Entries start with a line of mode and size, followed by the raw pixels
+        try:
+            with tracer.stage('cache load', os.path.getsize(path)):
+                with open(path, 'rb') as entry:
+                    mode, width, height = entry.readline().decode().split()
+                    new_image = Image.frombytes(mode, (int(width), int(height)), entry.read())
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        # Loaded entries become the most recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return new_image
+
+    def store(self, key, new_image):
+        """Stores an image with a key and evicts entries while over budget.
+
+        P images are not stored, filtering their palette is faster than loading them.
+        """
+        if new_image.mode == 'P':
+            return
+
+        data = new_image.tobytes()
+        if len(data) > self.budget:
+            return
+
+        with tracer.stage('cache store', len(data)):
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(file_descriptor, 'wb') as entry:
+                    entry.write(f'{new_image.mode} {new_image.width} {new_image.height}\n'.encode())
+                    entry.write(data)
+                os.replace(temporary_path, self.path(key))
+            except OSError:
+                # A cache that can't be written only means results are computed again
+                try:
+                    os.remove(temporary_path)
+                except OSError:
+                    pass
+                return
+
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache is within budget."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+
+            # Temporary files are only removed once no writer can still be using them
+            if entry.name.endswith('.tmp'):
+                if time.time() - stat.st_mtime > TEMPORARY_FILE_AGE:
+                    self.remove(entry.path)
+            elif entry.name.endswith('.img'):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.budget:
+                break
+            self.remove(path)
+            total_size -= size
+
+    def remove(self, path):
+        """Removes an entry, which another process may already have removed."""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
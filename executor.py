@@ -0,0 +1,271 @@
+"""This module contains the FilterExecutor class."""
+from itertools import islice
+from multiprocessing import cpu_count, get_context, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from queue import Queue
+from threading import Lock
+
+import numpy as np
+from PIL import Image
+
+import tiling
+from filters import COMPACT_MODES, FILTER_TRAITS, check_mode, filter_pixels
+from pipeline import FilterPipeline, compact_gray, compact_image
+from tracing import tracer
+
+# Shared memory buffers a worker process is attached to, by name
+attached_buffers = {}
+
+def attach_buffers(*names):
+    """Attaches the worker to shared memory buffers and detaches it from stale ones."""
+    for name in list(attached_buffers):
+        if name not in names:
+            attached_buffers.pop(name).close()
+
+    for name in names:
+        if name not in attached_buffers:
+            attached_buffers[name] = SharedMemory(name=name)
+
+    return [attached_buffers[name].buf for name in names]
+
+def filter_tile(source_name, target_name, control_name, shape, box, kernel):
+    """Runs a kernel over a tile from the shared source buffer into the shared target buffer.
+
+    The tile is skipped if the shared control flag is set, which cancels an apply.
+    """
+    source_buffer, target_buffer, control_buffer = attach_buffers(source_name, target_name,
+        control_name)
+    if control_buffer[0]:
+        return
+
+    source_pixels = np.ndarray(shape, dtype=np.uint8, buffer=source_buffer)
+    target_pixels = np.ndarray(shape, dtype=np.uint8, buffer=target_buffer)
+
+    left, upper, right, lower = box
+    filter_pixels(source_pixels[upper:lower, left:right], kernel, 1,
+        out=target_pixels[upper:lower, left:right])
+
+def filter_tile_task(task):
+    """Runs filter_tile with the arguments of a task, for pool methods taking one argument.
+
+    Returns the box of the tile.
+    """
+    filter_tile(*task)
+    return task[4]
+
+class FilterExecutor:
+    """This class contains a long-lived worker pool that filters images in shared memory."""
+    def __init__(self, processes=None, start_method=None, tile_size=tiling.TILE_SIZE,
+            oversubscription=tiling.OVERSUBSCRIPTION, square=False):
+        self.processes = processes or cpu_count()
+        self.tile_size = tile_size
+        self.oversubscription = oversubscription
+        self.square = square
+
+        # Workers must share the resource tracker of this process, otherwise
+        # each of them unlinks the shared buffers it attached to when it exits
+        resource_tracker.ensure_running()
+        with tracer.stage('pool start', workers=self.processes):
+            self.pool = get_context(start_method).Pool(self.processes)
+        self.source = None
+        self.target = None
+
+        # Workers skip the remaining tiles of an apply once this flag is set
+        self.control = SharedMemory(create=True, size=1)
+
+        # Shared buffers can only be used by one apply at a time
+        self.lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def reserve(self, size):
+        """Makes sure the shared buffers can hold an image of a given number of bytes."""
+        if self.source is not None and self.source.size >= size:
+            return
+
+        self.release()
+        self.source = SharedMemory(create=True, size=size)
+        self.target = SharedMemory(create=True, size=size)
+
+    def release(self):
+        """Frees the shared buffers."""
+        for buffer in (self.source, self.target):
+            if buffer is not None:
+                buffer.close()
+                buffer.unlink()
+
+        self.source = None
+        self.target = None
+
+    def run_tiles(self, tasks, workers):
+        """Runs filter_tile_task over tasks with at most a number of them in flight at once.
+
+        Yields the box of each tile in the order they finish. Workers beyond the
+        number wait, so fewer workers than the pool size really run in parallel.
+        If a tile fails, the remaining tiles are skipped and waited for before its
+        error is raised, so no worker is left writing into the shared buffers.
+        """
+        error = None
+        for result in self.tile_results(tasks, workers):
+            if not isinstance(result, Exception):
+                if error is None:
+                    yield result
+            elif error is None:
+                error = result
+                self.control.buf[0] = 1
+
+        if error is not None:
+            raise error
+
+    def tile_results(self, tasks, workers):
+        """Yields the box of each finished tile of run_tiles, or the error of a failed tile."""
+        if workers >= self.processes:
+            results = self.pool.imap_unordered(filter_tile_task, tasks)
+            while True:
+                try:
+                    yield next(results)
+                except StopIteration:
+                    return
+                except Exception as exc:
+                    yield exc
+
+        # A new task is sent each time one finishes, results arrive from the pool thread
+        finished = Queue()
+        tasks = iter(tasks)
+        in_flight = 0
+        for task in islice(tasks, workers):
+            self.pool.apply_async(filter_tile_task, (task,), callback=finished.put,
+                error_callback=finished.put)
+            in_flight += 1
+
+        while in_flight:
+            result = finished.get()
+            in_flight -= 1
+            for task in islice(tasks, 1):
+                self.pool.apply_async(filter_tile_task, (task,), callback=finished.put,
+                    error_callback=finished.put)
+                in_flight += 1
+            yield result
+
+    def apply(self, current_image, image_filter, intensity):
+        """Applies a filter to an RGB or RGBA image using the worker pool."""
+        # Filters that don't use the intensity slider signal it by returning False
+        if not FILTER_TRAITS[image_filter].uses_intensity and intensity != 1:
+            return False
+
+        return self.apply_pipeline(current_image, FilterPipeline([(image_filter, intensity)]))
+
+    def apply_pipeline(self, current_image, pipeline, cancelled=None, progress=None,
+            tiles=None, workers=None, tile_size=None):
+        """Applies all filters of a pipeline to an image using the worker pool.
+
+        Images can be RGB or RGBA, or L, LA, 1 or P images, see FusedStage.apply.
+        Returns None if the cancelled event is set before the last tile is done,
+        tiles not started yet are then skipped. Progress is called with the number
+        of finished tiles and the total number of tiles over all passes each time
+        a tile is finished. Tiles is called with the box and pixel array of each
+        finished tile of the last pass, in the order they finish. The array is
+        only valid during the call. Images are split into tiles for a number of
+        workers and a tile size if given, and at most that many workers filter
+        tiles at once, see ExecutionPlanner.
+        """
+        # Passes over single channel images are lookup tables and passes over P images
+        # only filter the palette, they are run in this process until a pass expands
+        # the image to color
+        stages = pipeline.compile()
+        while stages and (current_image.mode in COMPACT_MODES or current_image.mode == 'P'):
+            if cancelled is not None and cancelled.is_set():
+                return None
+            current_image = stages.pop(0).apply(current_image)
+
+        if not stages:
+            return current_image
+
+        check_mode(current_image)
+
+        workers = min(workers or self.processes, self.processes)
+        with self.lock:
+            # Copy image into shared memory, workers only receive buffer names and tile boxes
+            shape = (current_image.height, current_image.width, len(current_image.getbands()))
+            size = shape[0] * shape[1] * shape[2]
+            self.reserve(size)
+            with tracer.stage('copy in', size):
+                np.ndarray(shape, dtype=np.uint8, buffer=self.source.buf)[...] = current_image
+
+            # Split image into cache sized tiles, several for each worker
+            boxes = tiling.split(current_image.size, shape[2], workers,
+                tile_size or self.tile_size, self.oversubscription, self.square)
+
+            # Run each fused pass over all tiles, its output is the input of the next pass
+            self.control.buf[0] = 0
+            for stage_index, stage in enumerate(stages):
+                if cancelled is not None and cancelled.is_set():
+                    return None
+                target_pixels = np.ndarray(shape, dtype=np.uint8, buffer=self.target.buf)
+
+                # Passes reading neighbouring pixels can't be split into tiles,
+                # they are run over the whole image in this process
+                if stage.radius:
+                    with tracer.stage('filter', size * 2):
+                        filter_pixels(np.ndarray(shape, dtype=np.uint8, buffer=self.source.buf),
+                            stage, 1, out=target_pixels)
+                    if progress is not None:
+                        progress((stage_index + 1) * len(boxes), len(stages) * len(boxes))
+                    if tiles is not None and stage_index == len(stages) - 1:
+                        tiles((0, 0, shape[1], shape[0]), target_pixels)
+
+                    del target_pixels
+                    self.source, self.target = self.target, self.source
+                    continue
+
+                # Each pass reads and writes every pixel once
+                with tracer.stage('filter', size * 2, workers):
+                    tasks = self.run_tiles([(self.source.name, self.target.name,
+                        self.control.name, shape, box, stage) for box in boxes], workers)
+
+                    # Tiles are collected as they finish, after a cancel the remaining
+                    # ones are skipped but still waited for, so no worker is left
+                    # writing into buffers the next apply uses
+                    for tile_index, (left, upper, right, lower) in enumerate(tasks, 1):
+                        if cancelled is not None and cancelled.is_set():
+                            self.control.buf[0] = 1
+                            continue
+
+                        if progress is not None:
+                            progress(stage_index * len(boxes) + tile_index,
+                                len(stages) * len(boxes))
+                        if tiles is not None and stage_index == len(stages) - 1:
+                            tiles((left, upper, right, lower),
+                                target_pixels[upper:lower, left:right])
+
+                del target_pixels
+                if self.control.buf[0]:
+                    return None
+
+                self.source, self.target = self.target, self.source
+
+            with tracer.stage('copy out', size):
+                new_image = Image.frombytes(current_image.mode, current_image.size,
+                    self.source.buf[:size])
+
+                # Passes that always leave every channel gray only need their first
+                # channel, others are checked for gray pixels like FusedStage.apply does
+                if stages[-1].gray_output():
+                    new_image = compact_image(new_image.getchannel(0),
+                        new_image.getchannel('A') if new_image.mode == 'RGBA' else None)
+                else:
+                    new_image = compact_gray(new_image)
+
+                return new_image
+
+    def close(self):
+        """Stops the worker pool and frees the shared buffers."""
+        self.pool.close()
+        self.pool.join()
+        self.release()
+        self.control.close()
+        self.control.unlink()
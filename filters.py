@@ -1,12 +1,219 @@
 """This module contains the filters that can be applied to an image."""
+from functools import lru_cache, wraps
+
+import numpy as np
 from PIL import Image
 
+# Engines the filters can run on, 'lut' runs per-channel filters as lookup tables and
+# everything else as whole-array kernels, 'numpy' runs whole-array kernels only and
+# 'python' runs the original per-pixel loops, which are kept as reference
+ENGINES = ('lut', 'numpy', 'python')
+current_engine = 'lut'
+
+def set_engine(engine):
+    """Sets the engine used by all filters."""
+    global current_engine
+
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown filter engine: {engine}')
+
+    current_engine = engine
+
+def filter_pixels(pixels, kernel, intensity, out=None):
+    """Runs a kernel over an (H, W, C) pixel array, keeping alpha unchanged."""
+    if out is None:
+        out = np.empty_like(pixels)
+
+    # Kernels only see the color channels, alpha is copied as is
+    out[..., :3] = kernel(pixels[..., :3], intensity)
+    if pixels.shape[2] == 4:
+        out[..., 3] = pixels[..., 3]
+
+    return out
+
+def check_mode(current_image):
+    """Raises an error if the image is not an RGB or RGBA image."""
+    if current_image.mode not in ('RGB', 'RGBA'):
+        raise ValueError(f'Unsupported image mode: {current_image.mode}')
+
+# Modes that keep images whose channels all hold the same value, such as grayscale
+# results, in a single channel, with the mode each of them expands to
+COMPACT_MODES = {'L': 'RGB', '1': 'RGB', 'LA': 'RGBA'}
+
+def to_filter_mode(current_image):
+    """Converts an image to RGB, or RGBA if it has transparency, so filters can be applied."""
+    if current_image.mode in ('RGB', 'RGBA'):
+        return current_image
+
+    has_alpha = 'A' in current_image.getbands() or 'transparency' in current_image.info
+    return current_image.convert('RGBA' if has_alpha else 'RGB')
+
+def apply_palette(current_image, kernel, intensity):
+    """Applies a point-wise kernel to the palette of a P image, keeping its pixels.
+
+    Pixels keep their palette indices, so transparency indices stay the same.
+    Images with palettes other than RGB or RGBA are expanded first.
+    """
+    # Palettes of images opened from a file are only read once the image is loaded
+    current_image.load()
+    palette_mode = current_image.palette.mode
+    if palette_mode not in ('RGB', 'RGBA'):
+        return apply_kernel(to_filter_mode(current_image), kernel, intensity)
+
+    # The palette is filtered as a row of pixels, one for each entry
+    entries = np.frombuffer(current_image.palette.tobytes(), dtype=np.uint8).reshape(
+        1, -1, len(palette_mode))
+    new_image = current_image.copy()
+    new_image.putpalette(filter_pixels(entries, kernel, intensity).tobytes(), palette_mode)
+    return new_image
+
+def apply_kernel(current_image, kernel, intensity):
+    """Applies a whole-array kernel to an RGB or RGBA image."""
+    check_mode(current_image)
+
+    return Image.fromarray(filter_pixels(np.asarray(current_image), kernel, intensity))
+
+@lru_cache(maxsize=None)
+def compile_lut(kernel, intensity, band_count):
+    """Compiles a per-channel kernel into a 256-entry lookup table for each band."""
+    # Run the kernel once over every possible channel value
+    values = np.arange(256, dtype=np.uint8)
+    ramp = np.repeat(values[:, np.newaxis], 3, axis=1)[np.newaxis]
+    tables = np.broadcast_to(kernel(ramp, intensity), ramp.shape)[0].T.tolist()
+
+    # Alpha band is mapped to itself
+    if band_count == 4:
+        tables.append(values.tolist())
+
+    return tuple(value for table in tables for value in table)
+
+def apply_lut(current_image, kernel, intensity):
+    """Applies a per-channel kernel to an RGB or RGBA image through a lookup table."""
+    check_mode(current_image)
+
+    return current_image.point(compile_lut(kernel, intensity, len(current_image.getbands())))
+
+def swap_channels(current_image, order):
+    """Reorders the color channels of an RGB or RGBA image, keeping alpha unchanged."""
+    check_mode(current_image)
+
+    bands = current_image.split()
+    return Image.merge(current_image.mode, [bands[index] for index in order] + list(bands[3:]))
+
+class MatrixKernel:
+    """This class contains a kernel that mixes the channels of a pixel array through a matrix.
+
+    Each new channel is the sum of the weighted channels, truncated and clamped.
+    """
+    def __init__(self, matrix):
+        self.matrix = tuple(tuple(row) for row in matrix)
+
+    def __call__(self, channels, intensity):
+        """Mixes the channels of a pixel array."""
+        red_channel, green_channel, blue_channel = np.moveaxis(channels.astype(np.float64), 2, 0)
+
+        # Sums are done in the same order as the reference loops to get identical rounding
+        new_channels = np.stack([(red_channel * red_weight) + (green_channel * green_weight) +
+            (blue_channel * blue_weight) for red_weight, green_weight, blue_weight in self.matrix],
+            axis=2)
+
+        # Pixel values must be between 0 and 255
+        return np.clip(new_channels, 0, 255).astype(np.uint8)
+
+class FilterTraits:
+    """This class contains the kernel of a registered filter and the traits engines use to
+    pick the fastest way to run it.
+
+    Per-channel filters can be run as lookup tables, channel orders as band swaps,
+    single channel filters leave the same value in every channel, binary ones only
+    black and white, and filters with a radius read neighbouring pixels, so they
+    can't be split into tiles. Alpha is always kept unchanged, see filter_pixels.
+    """
+    def __init__(self, name, label, reference, kernel=None, matrix=None, per_channel=False,
+            channel_order=None, single_channel=False, binary=False, uses_intensity=False,
+            radius=0):
+        self.name = name
+        self.label = label
+        self.reference = reference
+        self.kernel = kernel
+        self.matrix = matrix
+        self.per_channel = per_channel
+        self.channel_order = channel_order
+        self.single_channel = single_channel or binary
+        self.binary = binary
+        self.uses_intensity = uses_intensity
+        self.radius = radius
+
+        # Matrix filters get their kernel from the matrix, a diagonal matrix scales each
+        # channel on its own and a matrix with equal rows leaves every channel gray
+        if matrix is not None:
+            weights = np.array(matrix, dtype=np.float64)
+            self.kernel = kernel or MatrixKernel(matrix)
+            self.per_channel = per_channel or not np.count_nonzero(
+                weights - np.diag(np.diag(weights)))
+            self.single_channel = self.single_channel or bool((weights == weights[0]).all())
+
+        if self.kernel is None:
+            raise ValueError(f'Filter {name} needs a kernel or a matrix')
+        if radius and (self.per_channel or channel_order is not None):
+            raise ValueError(f'Filter {name} can not read neighbouring pixels and be point-wise')
+
+    def apply(self, current_image, intensity):
+        """Applies the filter to an RGB, RGBA or P image with the fastest engine allowed."""
+        # Filters that don't use the intensity slider signal it by returning False
+        if not self.uses_intensity and intensity != 1:
+            return False
+
+        # Point-wise filters map the palette of P images instead of their pixels,
+        # other filters and the reference loops need them expanded
+        if current_image.mode == 'P':
+            if not self.radius and current_engine != 'python':
+                return apply_palette(current_image, self.kernel, intensity)
+            current_image = to_filter_mode(current_image)
+
+        # Reorder channels or run lookup table or whole-array kernel unless the per-pixel
+        # reference loops are selected
+        if current_engine == 'python':
+            return self.reference(current_image, intensity)
+        if current_engine == 'lut' and self.channel_order is not None:
+            return swap_channels(current_image, self.channel_order)
+        if current_engine == 'lut' and self.per_channel:
+            return apply_lut(current_image, self.kernel, intensity)
+        return apply_kernel(current_image, self.kernel, intensity)
+
+# Traits of each registered filter, and the filters by name, as used in recipes
+# such as 'sepia,lighter:3', in the order they are listed
+FILTER_TRAITS = {}
+FILTERS = {}
+
+def register_filter(name, label, **traits):
+    """Returns a decorator that registers a filter with a name, a label and its traits.
+
+    The decorated function holds the per-pixel reference loops, the registered filter
+    runs on the engine its traits allow, see FilterTraits. Registered filters are listed
+    in the GUI and run fused and in parallel by pipelines.
+    """
+    def register(reference):
+        filter_traits = FilterTraits(name, label, reference, **traits)
+
+        @wraps(reference)
+        def image_filter(current_image, intensity):
+            return filter_traits.apply(current_image, intensity)
+
+        FILTER_TRAITS[image_filter] = filter_traits
+        FILTERS[name] = image_filter
+        return image_filter
+
+    return register
+
+def grayscale_kernel(channels, intensity):
+    """Averages the channels of a pixel array."""
+    average_channel = channels.sum(axis=2, dtype=np.uint16) // 3
+    return average_channel.astype(np.uint8)[..., np.newaxis]
+
+@register_filter('grayscale', 'Grayscale', kernel=grayscale_kernel, single_channel=True)
 def grayscale_filter(current_image, intensity):
     """Makes image grayscale."""
-    # This filter does not use the intensity slider
-    if intensity != 1:
-        return False
-
     # If RGB image, apply filter to all channels
     if current_image.mode == 'RGB':
         # Create new RGB image with same size as current image where changes can be saved
@@ -43,12 +250,13 @@ def grayscale_filter(current_image, intensity):
 
     return new_image
 
+def invert_kernel(channels, intensity):
+    """Rotates the channels of a pixel array."""
+    return channels[..., [1, 2, 0]]
+
+@register_filter('invert', 'Invert', kernel=invert_kernel, channel_order=(1, 2, 0))
 def invert_filter(current_image, intensity):
     """Makes image colors inverted."""
-    # This filter does not use the intensity slider
-    if intensity != 1:
-        return False
-
     # If RGB image, apply filter to all channels
     if current_image.mode == 'RGB':
         # Create new RGB image with same size as current image where changes can be saved
@@ -80,12 +288,16 @@ def invert_filter(current_image, intensity):
 
     return new_image
 
+def black_and_white_kernel(channels, intensity):
+    """Thresholds a pixel array to black or white."""
+    # Pixels more light than dark become white, the rest black
+    light_pixels = channels.sum(axis=2, dtype=np.uint16) > 382.5
+    return np.where(light_pixels, 255, 0).astype(np.uint8)[..., np.newaxis]
+
+@register_filter('black_and_white', 'Black and white', kernel=black_and_white_kernel,
+    binary=True)
 def black_and_white_filter(current_image, intensity):
     """Makes image black and white."""
-    # This filter does not use the intensity slider
-    if intensity != 1:
-        return False
-
     # If RGB image, apply filter to all channels
     if current_image.mode == 'RGB':
         # Create new RGB image with same size as current image where changes can be saved
@@ -140,12 +352,12 @@ def black_and_white_filter(current_image, intensity):
 
     return new_image
 
+# Weights of the red, green and blue channels in each channel of sepia toned pixels
+SEPIA_MATRIX = ((0.393, 0.769, 0.189), (0.349, 0.686, 0.168), (0.272, 0.534, 0.131))
+
+@register_filter('sepia', 'Sepia', matrix=SEPIA_MATRIX)
 def sepia_filter(current_image, intensity):
     """Makes image sepia toned."""
-    # This filter does not use the intensity slider
-    if intensity != 1:
-        return False
-
     # If RGB image, apply filter to all channels
     if current_image.mode == 'RGB':
         # Create new RGB image with same size as current image where changes can be saved
@@ -202,12 +414,16 @@ def sepia_filter(current_image, intensity):
 
     return new_image
 
+def cold_kernel(channels, intensity):
+    """Cold tones a pixel array."""
+    new_channels = channels * np.array((0.9, 0.9, 1.1))
+
+    # Pixel values can't be higher than 255
+    return np.minimum(new_channels, 255).astype(np.uint8)
+
+@register_filter('cold', 'Cold', kernel=cold_kernel, per_channel=True)
 def cold_filter(current_image, intensity):
     """Makes image cold toned."""
-    # This filter does not use the intensity slider
-    if intensity != 1:
-        return False
-
     # If RGB image, apply filter to all channels
     if current_image.mode == 'RGB':
         # Create new RGB image with same size as current image where changes can be saved
@@ -258,12 +474,16 @@ def cold_filter(current_image, intensity):
 
     return new_image
 
+def warm_kernel(channels, intensity):
+    """Warm tones a pixel array."""
+    new_channels = channels * np.array((1.2, 1.05, 0.9))
+
+    # Pixel values can't be higher than 255
+    return np.minimum(new_channels, 255).astype(np.uint8)
+
+@register_filter('warm', 'Warm', kernel=warm_kernel, per_channel=True)
 def warm_filter(current_image, intensity):
     """Makes image warm toned."""
-    # This filter does not use the intensity slider
-    if intensity != 1:
-        return False
-
     # If RGB image, apply filter to all channels
     if current_image.mode == 'RGB':
         # Create new RGB image with same size as current image where changes can be saved
@@ -314,12 +534,21 @@ def warm_filter(current_image, intensity):
 
     return new_image
 
+def colorful_kernel(channels, intensity):
+    """Keeps only the strongest channel of each pixel in a pixel array."""
+    red_channel, green_channel, blue_channel = np.moveaxis(channels, 2, 0)
+
+    # Pixels without a single strongest channel become white
+    new_channels = np.full(channels.shape, 255, dtype=np.uint8)
+    new_channels[(red_channel > green_channel) & (red_channel > blue_channel)] = (255, 0, 0)
+    new_channels[(green_channel > red_channel) & (green_channel > blue_channel)] = (0, 255, 0)
+    new_channels[(blue_channel > red_channel) & (blue_channel > green_channel)] = (0, 0, 255)
+
+    return new_channels
+
+@register_filter('colorful', 'Colorful', kernel=colorful_kernel)
 def colorful_filter(current_image, intensity):
     """Makes image colorful."""
-    # This filter does not use the intensity slider
-    if intensity != 1:
-        return False
-
     # If RGB image, apply filter to all channels
     if current_image.mode == 'RGB':
         # Create new RGB image with same size as current image where changes can be saved
@@ -388,6 +617,15 @@ def colorful_filter(current_image, intensity):
 
     return new_image
 
+def lighter_kernel(channels, intensity):
+    """Lightens a pixel array."""
+    new_channels = channels + np.float64(intensity * 10)
+
+    # Pixel values can't be higher than 255
+    return np.clip(new_channels, 0, 255).astype(np.uint8)
+
+@register_filter('lighter', 'Lighter (1-10)', kernel=lighter_kernel, per_channel=True,
+    uses_intensity=True)
 def lighter_filter(current_image, intensity):
     """Makes image lighter."""
     intensity *= 10
@@ -442,6 +680,15 @@ def lighter_filter(current_image, intensity):
 
     return new_image
 
+def darker_kernel(channels, intensity):
+    """Darkens a pixel array."""
+    new_channels = channels - np.float64(intensity * 10)
+
+    # Pixel values can't be lower than 0
+    return np.clip(new_channels, 0, 255).astype(np.uint8)
+
+@register_filter('darker', 'Darker (1-10)', kernel=darker_kernel, per_channel=True,
+    uses_intensity=True)
 def darker_filter(current_image, intensity):
     """Makes image darker."""
     intensity *= 10
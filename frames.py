@@ -0,0 +1,148 @@
+"""This module contains functions for filtering every frame of animations and multi-page images.
+
+Frames are decoded in order and filtered with a bounded number of frames in flight,
+so reading and filtering does not hold more frames as the frame count grows. TIFF
+pages are also written one at a time, other encoders keep every frame until the
+file is written.
+"""
+from collections import deque
+from itertools import chain
+
+from PIL import Image, ImageSequence, TiffImagePlugin
+
+from filters import COMPACT_MODES, to_filter_mode
+from image import atomic_file, save_format
+from tracing import tracer
+
+# Settings of each frame that are kept, by their key in the frame info
+FRAME_SETTINGS = ('duration', 'disposal', 'blend')
+
+# Frames in flight for each worker of a pool
+FRAMES_PER_WORKER = 2
+
+def is_multi_frame(image_path):
+    """Checks if an image file holds more than one frame, such as an animation."""
+    with Image.open(image_path) as current_image:
+        return getattr(current_image, 'is_animated', False)
+
+def filter_frame(pipeline, frame):
+    """Applies a pipeline to one frame, run in a worker or in this process."""
+    # Frames in other modes, such as CMYK pages, are converted first
+    if frame.mode not in COMPACT_MODES and frame.mode != 'P':
+        frame = to_filter_mode(frame)
+
+    return pipeline.apply(frame)
+
+def common_mode(frames):
+    """Converts frames of different modes to RGB, or RGBA if any of them has transparency.
+
+    Returns the frames, unchanged if they all have the same mode.
+    """
+    if len({frame.mode for frame in frames}) <= 1:
+        return frames
+
+    frames = [to_filter_mode(frame) for frame in frames]
+    if any(frame.mode == 'RGBA' for frame in frames):
+        frames = [frame.convert('RGBA') for frame in frames]
+    return frames
+
+def filtered_frames(source, pipeline, pool=None, window=1):
+    """Yields the frames of an open image with a pipeline applied, in order.
+
+    Frames are filtered on a concurrent.futures pool if one is given, with at most
+    window frames in flight. Filtered frames keep the settings of their frame in
+    their info.
+    """
+    in_flight = deque()
+
+    for frame in ImageSequence.Iterator(source):
+        # Frames are copied since seeking to the next frame changes the source
+        frame = frame.copy()
+        settings = {key: frame.info[key] for key in FRAME_SETTINGS if key in frame.info}
+
+        # GIF frames keep their disposal outside of their info
+        if hasattr(source, 'disposal_method'):
+            settings['disposal'] = source.disposal_method
+
+        if pool is None:
+            new_frame = filter_frame(pipeline, frame)
+            new_frame.info.update(settings)
+            yield new_frame
+            continue
+
+        # The oldest frame is waited for once the window is full
+        in_flight.append((pool.submit(filter_frame, pipeline, frame), settings))
+        if len(in_flight) >= window:
+            future, settings = in_flight.popleft()
+            new_frame = future.result()
+            new_frame.info.update(settings)
+            yield new_frame
+
+    while in_flight:
+        future, settings = in_flight.popleft()
+        new_frame = future.result()
+        new_frame.info.update(settings)
+        yield new_frame
+
+def filter_frames(image_path, output_path, pipeline, pool=None, workers=1, save_options=None):
+    """Applies a pipeline to every frame of an image file and saves the frames to a path.
+
+    Frames are spread over a concurrent.futures pool with a given number of workers
+    if one is given. The loop count and the duration, disposal and blend of each
+    frame are kept. Formats that hold a single frame only get the first frame.
+    Returns the megapixels of all frames.
+    """
+    image_format = save_format(output_path)
+    format_options = dict((save_options or {}).get(image_format, {}))
+    window = workers * FRAMES_PER_WORKER if pool is not None else 1
+    megapixels = 0
+
+    with Image.open(image_path) as source:
+        # Encoders read the duration, disposal and blend of each frame from lists,
+        # which are filled as frames are filtered, before the encoder reaches them
+        durations = []
+        disposals = []
+        blends = []
+
+        def frames():
+            nonlocal megapixels
+            for new_frame in filtered_frames(source, pipeline, pool, window):
+                durations.append(new_frame.info.get('duration', 0))
+                disposals.append(new_frame.info.get('disposal', 0))
+                blends.append(new_frame.info.get('blend', 0))
+                megapixels += new_frame.width * new_frame.height / 1_000_000
+                yield new_frame
+
+        new_frames = frames()
+        first_frame = next(new_frames)
+        if 'loop' in source.info:
+            format_options.setdefault('loop', source.info['loop'])
+
+        with tracer.stage('encode frames'):
+            # TIFF pages are written as they are filtered, going back to link each page
+            with atomic_file(output_path, 'x+b' if image_format == 'TIFF' else 'xb') as file:
+                if image_format == 'TIFF':
+                    with TiffImagePlugin.AppendingTiffWriter(file, True) as tiff:
+                        for new_frame in chain([first_frame], new_frames):
+                            new_frame.save(tiff, image_format, **format_options)
+                            tiff.newFrame()
+
+                # GIF encoders read the frames once, as they are filtered, and take
+                # frames of any mode
+                elif image_format == 'GIF':
+                    first_frame.save(file, image_format, save_all=True,
+                        append_images=new_frames, duration=durations, disposal=disposals,
+                        blend=blends, **format_options)
+
+                # Other encoders read the frames more than once and need them in one
+                # mode, GIF frames after the first one are decoded as RGB or RGBA
+                elif image_format in Image.SAVE_ALL:
+                    first_frame, *other_frames = common_mode([first_frame] + list(new_frames))
+                    first_frame.save(file, image_format, save_all=True,
+                        append_images=other_frames, duration=durations, disposal=disposals,
+                        blend=blends, **format_options)
+
+                else:
+                    first_frame.save(file, image_format, **format_options)
+
+    return megapixels
@@ -0,0 +1,183 @@
+"""This module contains the ImageHistory class."""
+from collections import OrderedDict
+
+from pipeline import FilterPipeline
+from regions import RegionPipeline
+
+# Default number of bytes snapshots of filtered images may use
+HISTORY_BUDGET = 512 * 1024 * 1024
+
+# Default number of steps between snapshots that are kept after moving on
+CHECKPOINT_INTERVAL = 4
+
+def image_bytes(current_image):
+    """Returns the number of bytes Pillow uses for the pixels of an image."""
+    # Pillow stores pixels with more than one band in 4 bytes
+    pixel_size = 4 if len(current_image.getbands()) > 1 else 1
+    return current_image.width * current_image.height * pixel_size
+
+class ImageHistory:
+    """This class contains an original image, the filters applied to it and
+    snapshots of some of the results.
+
+    Snapshots are kept for the latest step and every checkpoint step. When
+    snapshots use more than the budget, the least recently used ones are
+    evicted and rebuilt later by replaying steps from the nearest snapshot.
+    Steps applied to a region keep the tiles they changed, which replay the
+    step and undo it without filtering.
+    """
+    def __init__(self, original, budget=HISTORY_BUDGET, interval=CHECKPOINT_INTERVAL):
+        self.original = original
+        self.budget = budget
+        self.interval = interval
+        self.steps = []
+        self.regions = []
+        self.changes = {}
+        self.snapshots = OrderedDict()
+
+    def __len__(self):
+        """Returns the number of images in the history, including the original."""
+        return len(self.steps) + 1
+
+    @property
+    def current(self):
+        """Returns the latest image."""
+        return self.image_at(len(self.steps))
+
+    def has_regions(self, index):
+        """Checks if any of the first steps up to a number of steps applies to a region."""
+        return any(region is not None for region in self.regions[:index])
+
+    def pipeline(self, first_index=0, last_index=None, reuse_changes=False):
+        """Returns a pipeline of the steps between two numbers of steps.
+
+        Steps applied to a region give a RegionPipeline, which reuses the kept
+        changes of region steps if asked to.
+        """
+        last_index = len(self.steps) if last_index is None else last_index
+        if not self.has_regions(last_index):
+            return FilterPipeline(self.steps[first_index:last_index])
+
+        # Steps on the whole image in a row are fused, region steps are one segment each
+        segments = []
+        for index in range(first_index + 1, last_index + 1):
+            image_filter, intensity = self.steps[index - 1]
+            region = self.regions[index - 1]
+            if region is None and segments and segments[-1][2] is None:
+                segments[-1] = (index, segments[-1][1].add(image_filter, intensity), None, None)
+            else:
+                segments.append((index, FilterPipeline([(image_filter, intensity)]), region,
+                    self.changes.get(index) if reuse_changes else None))
+
+        return RegionPipeline(segments)
+
+    def replay_plan(self, index):
+        """Returns the nearest earlier snapshot and a pipeline of the steps after it.
+
+        Returns None if the image after the given number of steps is already kept.
+        """
+        if index == 0 or index in self.snapshots:
+            return None
+
+        base_index = max((snapshot for snapshot in self.snapshots if snapshot < index),
+            default=0)
+        return self.image_at(base_index), self.pipeline(base_index, index, reuse_changes=True)
+
+    def image_at(self, index):
+        """Returns the image after a number of steps, replaying steps if needed."""
+        if index == 0:
+            return self.original
+
+        if index in self.snapshots:
+            self.snapshots.move_to_end(index)
+            return self.snapshots[index]
+
+        # Replay steps from the nearest earlier snapshot or the original
+        base_image, pipeline = self.replay_plan(index)
+        new_image = pipeline.apply(base_image)
+
+        self.keep_changes(getattr(pipeline, 'changes', None))
+        self.store(index, new_image)
+        return new_image
+
+    def store(self, index, new_image):
+        """Keeps a snapshot and evicts least recently used ones while over budget."""
+        self.snapshots[index] = new_image
+        self.snapshots.move_to_end(index)
+
+        # Latest snapshot is always kept, even if it alone is over budget
+        while len(self.snapshots) > 1 and self.snapshot_bytes() > self.budget:
+            self.snapshots.popitem(last=False)
+
+    def keep_changes(self, changes):
+        """Keeps the changes of region steps by step count, see RegionPipeline.apply."""
+        # Region steps that expanded the image mode have no change and are replayed
+        for index, change in (changes or {}).items():
+            if change is not None:
+                self.changes[index] = change
+
+    def complete(self, index, new_image, changes=None):
+        """Stores the image of the latest step, keeping earlier snapshots only at checkpoints.
+
+        Changes of region steps built with it are kept too.
+        """
+        for snapshot in list(self.snapshots):
+            if snapshot < index and snapshot % self.interval != 0:
+                del self.snapshots[snapshot]
+
+        self.keep_changes(changes)
+        self.store(index, new_image)
+
+    def add_step(self, image_filter, intensity, region=None):
+        """Adds a step whose image is built later, applied to a region if one is given."""
+        self.steps.append((image_filter, intensity))
+        self.regions.append(region)
+
+    def append(self, image_filter, intensity, new_image):
+        """Adds a step and the image it resulted in."""
+        self.add_step(image_filter, intensity)
+        self.complete(len(self.steps), new_image)
+
+    def extend(self, steps, new_image):
+        """Adds several steps and the image they resulted in."""
+        steps = list(steps)
+        if not steps:
+            return
+
+        # Steps before the last one get no snapshot and are replayed when needed
+        self.steps.extend(steps)
+        self.regions.extend([None] * len(steps))
+        self.complete(len(self.steps), new_image)
+
+    def pop(self):
+        """Removes the latest step."""
+        index = len(self.steps)
+
+        # Images before region steps are rebuilt by pasting back the tiles the step changed
+        change = self.changes.pop(index, None)
+        if change is not None and index in self.snapshots and index - 1 not in self.snapshots:
+            self.store(index - 1, change.revert(self.snapshots[index]))
+
+        self.snapshots.pop(index, None)
+        self.steps.pop()
+        self.regions.pop()
+
+    def reset(self):
+        """Removes all steps, leaving the original image."""
+        self.steps = []
+        self.regions = []
+        self.changes.clear()
+        self.snapshots.clear()
+
+    def snapshot_bytes(self):
+        """Returns the number of bytes used by snapshots."""
+        return sum(image_bytes(snapshot) for snapshot in self.snapshots.values())
+
+    def change_bytes(self):
+        """Returns the number of bytes used by the tiles kept for region steps."""
+        return sum(image_bytes(tile) for change in self.changes.values()
+            for tile in change.before + change.after)
+
+    def memory_usage(self):
+        """Returns the number of bytes used by the original image, snapshots and region tiles."""
+        return image_bytes(self.original) + self.snapshot_bytes() + self.change_bytes()
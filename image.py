@@ -1,113 +1,406 @@
-"""This module contains the PILImage class."""
+"""This module contains the PILImage class and functions for saving images."""
+import os
+import shutil
+from collections import OrderedDict
+from contextlib import contextmanager
+from math import ceil, floor
+from uuid import uuid4
+
 from PIL import Image
 
+import tiling
+from cache import image_digest, result_key
+from history import HISTORY_BUDGET, ImageHistory, image_bytes
+from pipeline import FilterPipeline
+from tracing import tracer
+
+# Number of live previews kept, enough for sweeping the intensity slider of a few filters
+LIVE_PREVIEW_COUNT = 32
+
+def parse_save_options(text):
+    """Parses encoder options such as 'png.compress_level=1,jpeg.quality=85' by format."""
+    options = {}
+    formats = set(Image.registered_extensions().values())
+
+    for option in filter(None, (option.strip() for option in text.split(','))):
+        name, _, value = option.partition('=')
+        image_format, _, setting = name.partition('.')
+        if image_format.upper() not in formats or not setting or not value:
+            raise ValueError(f'Invalid save option: {option}')
+
+        # Numbers are passed as numbers, 0 and 1 also work as booleans
+        options.setdefault(image_format.upper(), {})[setting] = \
+            int(value) if value.lstrip('-').isdigit() else value
+
+    return options
+
+def save_format(path):
+    """Returns the format an image is saved in at a path, by its extension."""
+    extension = os.path.splitext(path)[1].lower()
+    image_format = Image.registered_extensions().get(extension)
+    if image_format is None:
+        raise ValueError(f'Unknown file extension: {extension}')
+
+    return image_format
+
+@contextmanager
+def atomic_file(path, mode='xb'):
+    """Opens a file that replaces the file at a path once the block is done.
+
+    The file is a temporary file next to the path, which is removed if the block
+    fails, so a partial file is never left at the path. Modes must create the file.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    temporary_path = os.path.join(directory, f'.{name}.{uuid4().hex}.tmp')
+    try:
+        with open(temporary_path, mode) as file:
+            yield file
+
+        # Replaced files keep their permissions
+        if os.path.exists(path):
+            shutil.copymode(path, temporary_path)
+        os.replace(temporary_path, path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        raise
+
+def save_image(current_image, path, options=None):
+    """Saves an image without ever leaving a partial file at the path, see atomic_file.
+
+    Options are encoder settings by format, as returned by parse_save_options.
+    """
+    image_format = save_format(path)
+
+    with tracer.stage('encode', image_bytes(current_image)):
+        with atomic_file(path) as file:
+            current_image.save(file, image_format, **(options or {}).get(image_format, {}))
+
 class PILImage:
     """This class contains methods for opening, saving and manipulating an image."""
-    def __init__(self):
-        self.list = []
+    def __init__(self, history_budget=HISTORY_BUDGET, cache=None):
+        self.history = None
+        self.history_budget = history_budget
+        self.cache = cache
+        self.digest = None
         self.resized = None
+        self.previews = {}
+        self.live_previews = OrderedDict()
         self.path = None
+        self.animated = False
         self.current_sections = None
-        self.section_count = None
+        self.current_boxes = None
 
     def open(self, image_path):
         """Opens an image and sets it as the current image."""
-        # Try to open image and add it to list, if it fails, raise an error.
+        # Try to open image and start its history, if it fails, raise an error.
         try:
-            self.list = [Image.open(image_path)]
+            self.set_image(Image.open(image_path))
         except IOError as exc:
             raise IOError from exc
         else:
             self.path = image_path
 
-    def save(self, path):
-        """Saves the current image to a path."""
+            # Only the first frame is shown and filtered, other frames are filtered when saved
+            self.animated = getattr(self.history.original, 'is_animated', False)
+
+    def set_image(self, new_image):
+        """Sets an image as the original image, starting a new history."""
+        self.history = ImageHistory(new_image, self.history_budget)
+        self.digest = None
+        self.previews = {}
+        self.live_previews.clear()
+
+    @property
+    def current(self):
+        """Returns the current image."""
+        return self.history.current
+
+    def add(self, image_filter, intensity, new_image):
+        """Sets the result of applying a filter as the current image."""
+        self.history.append(image_filter, intensity, new_image)
+        self.forget_previews(len(self.history) - 1)
+
+    def apply(self, pipeline, region=None):
+        """Applies all filters of a pipeline to the current image in fused passes.
+
+        Filters applied to a region are applied and kept one step at a time, see Region.apply.
+        """
+        if region is not None:
+            for image_filter, intensity in pipeline.steps:
+                new_image, change = region.apply(self.current,
+                    FilterPipeline([(image_filter, intensity)]))
+                self.history.add_step(image_filter, intensity, region)
+                self.history.complete(len(self.history) - 1, new_image,
+                    {len(self.history) - 1: change})
+
+            self.forget_previews(len(self.history) - 1)
+            return
+
+        # Results found in the result cache are not computed again
+        steps = self.history.steps + pipeline.steps
+        new_image = self.cached_result(steps)
+        if new_image is None:
+            new_image = pipeline.apply(self.current)
+            self.cache_result(steps, new_image)
+
+        self.history.extend(pipeline.steps, new_image)
+        self.forget_previews(len(self.history) - 1)
+
+    def cached_result(self, steps):
+        """Returns the cached result of applying steps to the original image, or None.
+
+        Results of steps applied to a region are not cached.
+        """
+        if self.cache is None or not steps or self.history.has_regions(len(steps)):
+            return None
+
+        return self.cache.load(self.result_key(steps))
+
+    def cache_result(self, steps, new_image):
+        """Stores the result of applying steps to the original image in the result cache."""
+        if self.cache is not None and steps and not self.history.has_regions(len(steps)):
+            self.cache.store(self.result_key(steps), new_image)
+
+    def result_key(self, steps):
+        """Returns the result cache key of applying steps to the original image."""
+        # Original image is only hashed once
+        if self.digest is None:
+            self.digest = image_digest(self.history.original)
+
+        return result_key(self.digest, steps)
+
+    def add_step(self, image_filter, intensity, region=None):
+        """Adds a filter to the current image or a region of it, only filtering the resized image.
+
+        The full resolution image is built later, see pending_build.
+        """
+        # Filters work on single pixels, so filtering the resized image gives the preview
+        self.resized = self.live_preview(image_filter, intensity, region)
+
+        self.history.add_step(image_filter, intensity, region)
+        self.previews[len(self.history) - 1] = self.resized
+
+    def has_live_preview(self, image_filter, intensity, region=None):
+        """Checks if the live preview of a filter on the current image is already rendered."""
+        return (len(self.history) - 1, image_filter, intensity, region) in self.live_previews
+
+    def live_preview(self, image_filter, intensity, region=None):
+        """Returns the resized image with a filter applied, without adding a step.
+
+        Renders are memoized per step, filter, intensity and region. Renders go through
+        a pipeline so gray previews stay single channel, like the images they preview.
+        """
+        key = (len(self.history) - 1, image_filter, intensity, region)
+        if key not in self.live_previews:
+            pipeline = FilterPipeline([(image_filter, intensity)])
+            with tracer.stage('preview filter', image_bytes(self.resized)):
+                if region is None:
+                    self.live_previews[key] = pipeline.apply(self.resized)
+                else:
+                    self.live_previews[key] = region.scaled(self.history.original.size,
+                        self.resized.size).apply(self.resized, pipeline)[0]
+
+            # Oldest render is dropped when there are too many
+            if len(self.live_previews) > LIVE_PREVIEW_COUNT:
+                self.live_previews.popitem(last=False)
+
+        self.live_previews.move_to_end(key)
+        return self.live_previews[key]
+
+    def pending_build(self):
+        """Returns what is needed to build the current image at full resolution.
+
+        Returns a tuple of the step count, steps, base image and pipeline to apply
+        to the base image, or None if the current image is already built. The steps
+        lead from the original to the current image and can be used to look up
+        the result cache first.
+        """
+        index = len(self.history) - 1
+        replay_plan = self.history.replay_plan(index)
+        return None if replay_plan is None else (index, self.history.steps[:index], *replay_plan)
+
+    def complete(self, index, new_image, changes=None):
+        """Stores a built full resolution image and resizes it.
+
+        Images of region steps only resize the tiles the step changed into the
+        preview of the step before. Returns the boxes of the preview that changed,
+        or None if the whole preview was resized.
+        """
+        self.history.complete(index, new_image, changes)
+
+        change = self.history.changes.get(index)
+        base_preview = self.previews.get(index - 1)
+        if change is not None and base_preview is not None and \
+                base_preview.mode == new_image.mode:
+            return self.patch_preview(index, new_image, change, base_preview)
+
+        self.resize()
+        return None
+
+    def patch_preview(self, index, new_image, change, base_preview):
+        """Sets the preview of a region step to a preview with the changed tiles resized into it.
+
+        Returns the boxes of the preview that changed.
+        """
+        preview = base_preview.copy()
+        scale_x = preview.width / new_image.width
+        scale_y = preview.height / new_image.height
+        boxes = []
+
+        with tracer.stage('resize', sum(image_bytes(tile) for tile in change.after)):
+            for left, upper, right, lower in change.boxes:
+                box = (floor(left * scale_x), floor(upper * scale_y),
+                    min(ceil(right * scale_x), preview.width),
+                    min(ceil(lower * scale_y), preview.height))
+                if box[2] <= box[0] or box[3] <= box[1]:
+                    continue
+
+                # Tiles are resized from the part of the image under their preview box,
+                # so they match the pixels of a resize of the whole image
+                preview.paste(new_image.resize((box[2] - box[0], box[3] - box[1]),
+                    box=(box[0] / scale_x, box[1] / scale_y, box[2] / scale_x,
+                    box[3] / scale_y)), box[:2])
+                boxes.append(box)
+
+        self.resized = preview
+        self.forget_previews(index)
+        self.previews[index] = preview
+        return boxes
+
+    def revert_one_step(self):
+        """Reverts the current image to the last image."""
+        self.history.pop()
+        self.forget_previews(len(self.history))
+        self.restore_preview()
+
+    def revert_to_original(self):
+        """Reverts the current image to the original image."""
+        self.history.reset()
+        self.forget_previews(len(self.history))
+        self.restore_preview()
+
+    def forget_previews(self, first_index):
+        """Removes previews and live previews of a step and all steps after it."""
+        for index in [index for index in self.previews if index >= first_index]:
+            del self.previews[index]
+
+        for key in [key for key in self.live_previews if key[0] >= first_index]:
+            del self.live_previews[key]
+
+    def restore_preview(self):
+        """Sets the resized image to the preview of the current step."""
+        self.resized = self.previews.get(len(self.history) - 1)
+
+        # If there is no preview, resize the current image
+        if self.resized is None:
+            self.resize()
+
+    def memory_usage(self):
+        """Returns the number of bytes used by the image history."""
+        return self.history.memory_usage()
+
+    def save(self, path, options=None):
+        """Saves the current image to a path, see save_image."""
         # Try to save current image, if it fails, raise an error.
         try:
-            self.list[-1].save(path)
+            save_image(self.current, path, options)
         except IOError as exc:
             raise IOError from exc
         except ValueError as exc:
             raise ValueError from exc
 
-    def resize(self):
-        """Resizes the current image to fit the image label."""
+    def preview_size(self, size):
+        """Returns the size an image of a given size is resized to, to fit the image label."""
         image_max_width = 900
         image_max_height = 500
+        width, height = size
 
         # If image is wider than the max image label width,
         # resize it to the max width while keeping aspect ratio.
-        if self.list[-1].width > image_max_width:
+        if width > image_max_width:
             image_width = image_max_width
-            image_height = int(self.list[-1].height * image_max_width / self.list[-1].width)
+            image_height = int(height * image_max_width / width)
 
             # If image now is taller than the max image label height,
             # resize it to the max height while keeping aspect ratio.
             if image_height > image_max_height:
                 image_height = image_max_height
-                image_width = int(self.list[-1].width * image_max_height / self.list[-1].height)
+                image_width = int(width * image_max_height / height)
 
         # If image is taller than the max image label height,
         # resize it to the max height while keeping aspect ratio.
-        elif self.list[-1].height > image_max_height:
+        elif height > image_max_height:
             image_height = image_max_height
-            image_width = int(self.list[-1].width * image_max_height / self.list[-1].height)
+            image_width = int(width * image_max_height / height)
 
             # If image now is wider than the max image label width,
             # resize it to the max width while keeping aspect ratio.
             if image_width > image_max_width:
                 image_width = image_max_width
-                image_height = int(self.list[-1].height * image_max_width / self.list[-1].width)
+                image_height = int(height * image_max_width / width)
 
         # If image fits in image label max dimensions
         else:
-            image_width = self.list[-1].width
-            image_height = self.list[-1].height
+            image_width = width
+            image_height = height
 
         # Image dimensions can't be 0
-        image_width = max(image_width, 1)
-        image_height = max(image_height, 1)
+        return max(image_width, 1), max(image_height, 1)
+
+    def resize(self):
+        """Resizes the current image to fit the image label."""
+        # Resizes image and keeps it as the preview of the current step,
+        # live previews were rendered from the old preview
+        with tracer.stage('resize', image_bytes(self.current)):
+            self.resized = self.current.resize(self.preview_size(self.current.size))
+        self.forget_previews(len(self.history) - 1)
+        self.previews[len(self.history) - 1] = self.resized
 
-        # Resizes image
-        self.resized = self.list[-1].resize((image_width, image_height))
+    def draft_preview(self):
+        """Sets the preview of the original image from a reduced resolution decode.
 
-    def crop(self):
-        """Crops the current image into sections."""
-        image_sections = []
+        Only formats that can decode at reduced resolution, such as JPEG, are
+        supported. Returns False if the full image must be decoded for a preview.
+        """
+        with Image.open(self.path) as draft_image:
+            size = self.preview_size(draft_image.size)
 
-        # Get the width of all sections except last one
-        image_section_width = self.list[-1].width // self.section_count
+            # JPEG images are scaled down by up to 8 times while decoding
+            if draft_image.draft(draft_image.mode, size) is None:
+                return False
 
-        # Crop image into sections and add them to list (except last one)
-        for index in range(0, self.section_count - 1):
-            image_sections.append(self.list[-1].crop((image_section_width * index, 0,
-                image_section_width * (index + 1), self.list[-1].height)))
+            with tracer.stage('draft decode', image_bytes(draft_image)):
+                self.resized = draft_image.resize(size)
 
-        # If the image width is not divisible by the section count,
-        # last section will not be as wide as the others.
-        # We therefore crop the last section separately.
-        image_sections.append(self.list[-1].crop(
-            (image_section_width * (self.section_count - 1), 0,
-            self.list[-1].width, self.list[-1].height)))
+        self.previews[0] = self.resized
+        return True
 
-        self.current_sections = image_sections
+    def load(self):
+        """Decodes the full resolution original image, otherwise decoded when first used."""
+        with tracer.stage('decode', image_bytes(self.history.original)):
+            self.history.original.load()
+
+    def crop(self, workers=1, tile_size=tiling.TILE_SIZE, square=False):
+        """Crops the current image into tiles, several for each worker."""
+        # Get the boxes of all tiles, as row bands or square tiles
+        self.current_boxes = tiling.split(self.current.size, len(self.current.getbands()),
+            workers, tile_size, square=square)
+
+        # Crop image into tiles
+        with tracer.stage('crop', image_bytes(self.current)):
+            self.current_sections = [self.current.crop(box) for box in self.current_boxes]
 
     def merge(self):
-        """Merges the current image sections into one image."""
-        # Create new image with same mode and size as current image
-        if self.list[-1].mode == 'RGB':
-            new_image = Image.new(mode='RGB', size=self.list[-1].size)
-        elif self.list[-1].mode == 'RGBA':
-            new_image = Image.new(mode='RGBA', size=self.list[-1].size)
-
-        # Paste all sections into new image (except last one)
-        for index, new_image_section in enumerate(self.current_sections):
-            new_image.paste(new_image_section, (new_image_section.width * index, 0))
-
-        # Paste last section into new image separately,
-        # as it might not be the same width as the other sections
-        current_sections_length = len(self.current_sections) - 1
-        new_image.paste(self.current_sections[current_sections_length],
-            (self.current_sections[0].width * current_sections_length, 0))
-
-        self.list.append(new_image)
+        """Merges the current image sections into one image and returns it."""
+        with tracer.stage('merge', image_bytes(self.current)):
+            # Create new image with same mode and size as current image
+            new_image = Image.new(mode=self.current.mode, size=self.current.size)
+
+            # Paste every section at the position it was cropped from
+            for box, new_image_section in zip(self.current_boxes, self.current_sections):
+                new_image.paste(new_image_section, box[:2])
+
+        return new_image
@@ -1,19 +1,81 @@
 """Image Filters v1.0.0"""
+import os
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-from multiprocessing import Pool, cpu_count
-from threading import Thread
-from PIL import ImageTk
-
-from image import PILImage
-from filters import (grayscale_filter, invert_filter, black_and_white_filter, sepia_filter,
-    cold_filter, warm_filter, colorful_filter, lighter_filter, darker_filter)
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
+from threading import Event
+from PIL import Image, ImageDraw, ImageTk
+
+import tiling
+from cache import CACHE_BUDGET, ResultCache
+from executor import FilterExecutor
+from frames import filter_frames
+from history import HISTORY_BUDGET, image_bytes
+from image import PILImage, parse_save_options, save_image
+from planner import PLANNER_CACHE, ExecutionPlanner
+from regions import Region, RegionPipeline
+from tracing import tracer
+from filters import FILTER_TRAITS, FILTERS
+
+# Milliseconds between checks for a finished background build
+POLL_INTERVAL = 50
+
+# Milliseconds the intensity slider must rest before a new live preview is rendered
+PREVIEW_DELAY = 100
 
 def update_image_label(new_image):
     """Updates the image label to a new image."""
-    global image_tk
-    image_tk = ImageTk.PhotoImage(new_image)
+    global image_tk, shown_image, shown_preview
+
+    # Builds only draw into the label while it shows the preview they build
+    shown_preview = new_image
+
+    # Tk shows L and 1 images as they are but drops the alpha of LA images
+    if new_image.mode == 'LA':
+        new_image = new_image.convert('RGBA')
+
+    with tracer.stage('photo image', image_bytes(new_image)):
+        image_tk = ImageTk.PhotoImage(new_image)
     image_label.config(image=image_tk)
+    shown_image = new_image
+
+def patch_image_label(patches):
+    """Pastes (box, image) patches into the image shown by the image label."""
+    global shown_image
+
+    if shown_image is None:
+        return
+
+    # Patches are pasted into a copy, the shown image may be a preview of the history
+    patched_image = shown_image.convert(patches[0][1].mode)
+    for box, patch in patches:
+        if box[2] <= patched_image.width and box[3] <= patched_image.height:
+            patched_image.paste(patch, box[:2])
+
+    with tracer.stage('photo image', image_bytes(patched_image)):
+        image_tk.paste(patched_image)
+    shown_image = patched_image
+
+def update_memory_text():
+    """Updates the memory text to the memory used by the image history."""
+    text = f'History memory: {image.memory_usage() / 1024 ** 2:.1f} MB'
+
+    # Shows how often builds were found in the result cache
+    if result_cache is not None:
+        text += f' • Cache: {result_cache.hits} hits, {result_cache.misses} misses'
+
+    memory_text.config(text=text)
+
+def update_region_text():
+    """Updates the region text to the region filters are applied to."""
+    region_text.config(text='Region: whole image' if region is None else
+        f'Region: {region.describe()}')
+
+def update_trace_text(*names):
+    """Updates the trace text to the stages of the latest traces with the given names."""
+    traces = [tracer.last(name) for name in names]
+    trace_text.config(text='\n'.join(trace.summary() for trace in traces if trace is not None))
 
 def change_filter():
     """Changes the current filter to the selected one in the filter list."""
@@ -22,118 +84,297 @@ def change_filter():
     intensity_slider.set(1)
     apply_filter_button.config(state='active')
 
-    # Check filter list selection and set current filter
-    match filter_list.selection():
-        case ('I001',):
-            current_filter = grayscale_filter
-            intensity_slider.config(state='disabled')
-        case ('I002',):
-            current_filter = invert_filter
-            intensity_slider.config(state='disabled')
-        case ('I003',):
-            current_filter = black_and_white_filter
-            intensity_slider.config(state='disabled')
-        case ('I004',):
-            current_filter = sepia_filter
-            intensity_slider.config(state='disabled')
-        case ('I005',):
-            current_filter = cold_filter
-            intensity_slider.config(state='disabled')
-        case ('I006',):
-            current_filter = warm_filter
-            intensity_slider.config(state='disabled')
-        case ('I007',):
-            current_filter = colorful_filter
-            intensity_slider.config(state='disabled')
-        case ('I008',):
-            current_filter = lighter_filter
-            intensity_slider.config(state='active')
-        case ('I009',):
-            current_filter = darker_filter
-            intensity_slider.config(state='active')
+    # Filter list items are named after the registered filters, the intensity
+    # slider is only enabled for filters that use it
+    current_filter = FILTERS[filter_list.selection()[0]]
+    intensity_slider.config(
+        state='active' if FILTER_TRAITS[current_filter].uses_intensity else 'disabled')
+
+    request_live_preview()
 
 def change_intensity(event):
-    """Limits the intensity slider to integer values and updates text."""
+    """Limits the intensity slider to integer values, updates text and live preview."""
     value = int(float(event))
     intensity_slider.config(value=value)
     intensity_text.config(text=f'Intensity ({value})')
 
-def apply_filter_button_click():
-    """Disables buttons and applies filter to image."""
-    filter_list.config(selectmode='none')
-    apply_filter_button.config(state='disabled')
-    apply_filter_button.config(text='Applying filter...')
-    revert_one_step_button.config(state='disabled')
-    revert_to_original_button.config(state='disabled')
-    open_image_button.config(state='disabled')
-    save_image_button.config(state='disabled')
-    save_image_as_button.config(state='disabled')
+    request_live_preview()
 
-    # Starts status bar animation
-    status_bar.start(10)
+def request_live_preview():
+    """Shows the selected filter on the preview, rendering new previews once the slider rests."""
+    global preview_job
 
-    # Runs filter application process in a new thread to allow changes to the GUI
-    thread = Thread(target=apply_filter)
-    thread.start()
+    cancel_live_preview()
 
-def apply_filter():
-    """Applies the selected filter to the current image."""
-    image_sections = []
+    if image.history is None or current_filter is None:
+        return
 
-    # Adds image sections to list with the intensity value
-    for section in image.current_sections:
-        image_sections.append((section, intensity_slider.get()))
+    # If live preview is turned off, show the preview of the current image
+    if not live_preview.get():
+        update_image_label(image.resized)
+        return
+
+    # Rendered previews are shown at once, new ones are debounced
+    if image.has_live_preview(current_filter, intensity_slider.get(), region):
+        show_live_preview()
+    else:
+        preview_job = window.after(PREVIEW_DELAY, show_live_preview)
+
+def show_live_preview():
+    """Renders the selected filter on the preview and updates the image label."""
+    global preview_job
+
+    preview_job = None
+    with tracer.trace('preview'):
+        update_image_label(image.live_preview(current_filter, intensity_slider.get(), region))
+
+def cancel_live_preview():
+    """Cancels a live preview waiting to be rendered."""
+    global preview_job
+
+    if preview_job is not None:
+        window.after_cancel(preview_job)
+        preview_job = None
+
+def preview_point(event):
+    """Returns the point of the preview under the mouse, kept inside the preview."""
+    return (min(max(event.x, 0), image.resized.width), min(max(event.y, 0), image.resized.height))
+
+def region_box(start, end):
+    """Returns the box between two corners in any order."""
+    return (min(start[0], end[0]), min(start[1], end[1]), max(start[0], end[0]),
+        max(start[1], end[1]))
+
+def start_region(event):
+    """Starts selecting a region of the image by dragging over the preview."""
+    global region_start
+
+    if image.history is not None and image.resized is not None:
+        region_start = preview_point(event)
+
+def drag_region(event):
+    """Shows the region being selected as an outline on the preview."""
+    if region_start is None:
+        return
+
+    # Outline is drawn on a copy, the preview is kept as it is
+    outlined_image = image.resized.convert('RGBA' if 'A' in image.resized.getbands() else 'RGB')
+    ImageDraw.Draw(outlined_image).rectangle(region_box(region_start, preview_point(event)),
+        outline='red')
+    update_image_label(outlined_image)
+
+def finish_region(event):
+    """Sets the selected region as the region filters are applied to."""
+    global region, region_start
+
+    if region_start is None:
+        return
+
+    # Clicks without dragging select the whole image
+    box = region_box(region_start, preview_point(event))
+    region_start = None
+    if box[2] - box[0] < 2 or box[3] - box[1] < 2:
+        region = None
+    else:
+        region = Region(box).scaled(image.resized.size, image.history.original.size)
+
+    update_region_text()
+    update_image_label(image.resized)
+    request_live_preview()
 
-    # Applies filter to each image section in parallel using multiprocessing
-    with Pool(image.section_count) as pool:
-        image.current_sections = pool.starmap(current_filter, image_sections)
+def clear_region(event=None):
+    """Applies filters to the whole image again."""
+    global region
 
-    # Merges image sections to full image and resizes and updates label image
-    image.merge()
-    image.resize()
-    update_image_label(image.resized)
+    region = None
+    update_region_text()
+    if image.resized is not None:
+        update_image_label(image.resized)
+        request_live_preview()
 
-    # Enables buttons
-    filter_list.config(selectmode='browse')
-    apply_filter_button.config(text='Apply filter')
-    apply_filter_button.config(state='active')
+def apply_filter_button_click():
+    """Shows the filtered preview at once and builds the full resolution image in the background."""
+    cancel_live_preview()
+
+    # Filters the resized image only, so the preview is shown at once
+    with tracer.trace('preview'):
+        image.add_step(current_filter, intensity_slider.get(), region)
+        update_image_label(image.resized)
+
+    # Enables revert buttons
     revert_one_step_button.config(state='active')
     revert_to_original_button.config(state='active')
-    open_image_button.config(state='active')
-    save_image_button.config(state='active')
-    save_image_as_button.config(state='active')
 
-    # Stops status bar animation
-    status_bar.stop()
+    start_build()
+
+def start_build():
+    """Builds the current image at full resolution in the background, cancelling stale builds."""
+    global build_job
+
+    cancel_build()
+
+    # If current image is already built, there is nothing to do
+    pending_build = image.pending_build()
+    if pending_build is None:
+        update_memory_text()
+        return
+
+    # Applies the filters after the nearest built image in parallel using the worker pool
+    index, steps, base_image, pipeline = pending_build
+    cancelled = Event()
+    progress = {'done': 0, 'total': 1}
+    tiles = Queue()
+    future = background.submit(build_image, image, steps, base_image, pipeline, cancelled,
+        progress, tiles)
+    build_job = (future, cancelled, index, progress, tiles, image.resized)
+
+    # Resets status bar and checks for progress and the result from the GUI thread
+    status_bar.config(value=0)
+    window.after(POLL_INTERVAL, check_build, build_job)
+
+def build_image(pil_image, steps, base_image, pipeline, cancelled, progress, tiles):
+    """Builds a full resolution image as one trace, run in the background.
+
+    Looks the steps up in the result cache first, otherwise applies the pipeline
+    to the base image and stores the result in the cache. Finished tiles are put
+    on the tiles queue as (box, image) patches scaled to the preview. Returns the
+    image and the changes of the region steps that were built.
+    """
+    def update_progress(done, total):
+        progress.update(done=done, total=total)
+
+    # Tiles are scaled in this thread, the GUI thread only pastes them
+    preview_width, preview_height = pil_image.preview_size(base_image.size)
+    scale_x = preview_width / base_image.width
+    scale_y = preview_height / base_image.height
+
+    def send_tile(box, pixels):
+        left, upper, right, lower = (round(box[0] * scale_x), round(box[1] * scale_y),
+            round(box[2] * scale_x), round(box[3] * scale_y))
+        if right > left and lower > upper:
+            tiles.put(((left, upper, right, lower),
+                Image.fromarray(pixels).resize((right - left, lower - upper))))
+
+    with tracer.trace('build'):
+        new_image = pil_image.cached_result(steps)
+
+        # Region steps only filter the tiles they touch, which are not shown as they
+        # finish, the whole preview is patched once they are done
+        if new_image is None and isinstance(pipeline, RegionPipeline):
+            new_image = pipeline.apply(base_image, lambda current_image, segment:
+                planner.apply_pipeline(current_image, segment, cancelled, update_progress))
+            return new_image, pipeline.changes
+
+        if new_image is None:
+            new_image = planner.apply_pipeline(base_image, pipeline, cancelled, update_progress,
+                send_tile)
+            if new_image is not None:
+                pil_image.cache_result(steps, new_image)
+
+        return new_image, None
+
+def check_build(job):
+    """Stores the full resolution image once its background build is done.
+
+    Finished tiles and the built image are only shown while the image label shows
+    the preview being built, a live preview shown instead is rendered again.
+    """
+    global build_job, shown_preview
+
+    # Builds that were cancelled or replaced are ignored
+    if job is not build_job:
+        return
+
+    # Shows the share of finished tiles on the status bar
+    future, cancelled, index, progress, tiles, preview = job
+    status_bar.config(value=100 * progress['done'] / progress['total'])
+
+    # Patches the tiles finished since the last check into the shown image
+    patches = []
+    while True:
+        try:
+            patches.append(tiles.get_nowait())
+        except Empty:
+            break
+    if patches and not future.done() and shown_preview is preview:
+        patch_image_label(patches)
+
+    if not future.done():
+        window.after(POLL_INTERVAL, check_build, job)
+        return
+
+    build_job = None
+    status_bar.config(value=0)
+
+    # Resizes full resolution image and updates label image, region steps only
+    # patch the preview pixels their tiles cover
+    new_image, changes = future.result()
+    if new_image is not None and not cancelled.is_set():
+        showing_build = shown_preview is preview
+        with tracer.trace('display'):
+            changed_boxes = image.complete(index, new_image, changes)
+            if showing_build and changed_boxes is None:
+                update_image_label(image.resized)
+            elif showing_build:
+                if changed_boxes:
+                    patch_image_label([(box, image.resized.crop(box))
+                        for box in changed_boxes])
+                shown_preview = image.resized
+
+        # Live previews were rendered from the preview before the build, outlines of
+        # a region being selected are left as they are
+        if not showing_build and region_start is None:
+            if current_filter is None:
+                update_image_label(image.resized)
+            else:
+                request_live_preview()
+        update_memory_text()
+        update_trace_text('preview', 'build', 'display')
+
+def cancel_build():
+    """Cancels the background build of the full resolution image."""
+    global build_job
+
+    if build_job is not None:
+        build_job[1].set()
+        build_job = None
+        status_bar.config(value=0)
+
+def finish_build():
+    """Waits for the background build of the full resolution image to finish."""
+    if build_job is not None:
+        build_job[0].result()
+        check_build(build_job)
+
+def finish_decode():
+    """Waits for the background decode of the full resolution original image to finish."""
+    if decode_job is not None:
+        decode_job.result()
 
 def revert_one_step_button_click():
     """Reverts the current image to the last image."""
     # If current image is not original image, revert to last image
-    if len(image.list) >= 1:
-        image.list.pop()
+    if len(image.history) > 1:
+        cancel_live_preview()
+        image.revert_one_step()
 
-        # Divides image into sections
-        image.crop()
-
-        # Resizes image and updates image label
-        image.resize()
+        # Updates image label to the preview and builds the full resolution image if needed
         update_image_label(image.resized)
+        start_build()
 
         # If current image is original image, disable revert buttons
-        if len(image.list) == 1:
+        if len(image.history) == 1:
             revert_one_step_button.config(state='disabled')
             revert_to_original_button.config(state='disabled')
 
 def revert_to_original_button_click():
     """Reverts the current image to the original image."""
-    image.list = [image.list[0]]
-
-    # Divides image into sections
-    image.crop()
+    cancel_live_preview()
+    image.revert_to_original()
 
-    # Resizes image and updates image label
-    image.resize()
+    # Updates image label to the preview of the original image
     update_image_label(image.resized)
+    start_build()
 
     # Disables revert buttons
     revert_one_step_button.config(state='disabled')
@@ -143,52 +384,57 @@ def open_image_button_click():
     """Opens filedialog for image and sets it as the current image."""
     file_path = filedialog.askopenfilename(filetypes = (
         ('PNG (transparency support)', '*.png'),
-            ('JPG (no transparency support)', '*.jpg')))
+            ('JPG (no transparency support)', '*.jpg'),
+                ('GIF (palette images)', '*.gif'),
+                    ('TIFF (multi-page images)', '*.tif *.tiff')))
 
     if file_path != '':
-        global image
+        global image, decode_job, region
+
+        # Builds, live previews and the region of the previous image are no longer needed
+        cancel_build()
+        cancel_live_preview()
+        region = None
+        update_region_text()
 
         # Checks if file is an image
         try:
-            image = PILImage()
+            image = PILImage(history_budget, result_cache)
             image.open(file_path)
         except IOError:
             # If file is not an image, show error message
             messagebox.showerror(
                 'File error', f'The selected file ({file_path}) is not an image.')
         else:
-            # CPU count is used to determine the number of sections to split the image into
-            if image.list[-1].width >= cpu_count():
-                image.section_count = cpu_count()
-            else:
-                image.section_count = image.list[-1].width
-
-            # Divides image into sections
-            image.crop()
-
-            # Resizes image and updates image label
-            image.resize()
-            update_image_label(image.resized)
+            # Shows a preview decoded at reduced resolution at once if the format allows it,
+            # the full image is then decoded in the background, before any build starts
+            # since builds run on the same thread, otherwise resizes the full image
+            with tracer.trace('open'):
+                if image.draft_preview():
+                    decode_job = background.submit(image.load)
+                else:
+                    decode_job = None
+                    image.resize()
+                update_image_label(image.resized)
+            update_memory_text()
+            update_trace_text('open')
 
             # Configures GUI
             window.title(f'Image Filters v1.0.0 • {file_path}')
             image_label.place(relx=0.5, rely=0.5, anchor='center')
+            revert_one_step_button.config(state='disabled')
+            revert_to_original_button.config(state='disabled')
             save_image_button.config(state='active')
             save_image_as_button.config(state='active')
             filter_list.config(selectmode='browse')
 
 def save_image_button_click():
     """Saves the image to the path it was opened from."""
-    # Try to save image, if it fails, show error message
-    try:
-        image.save(image.path)
-    except IOError:
-        messagebox.showerror('Image save error',
-            f'The image could not be saved at path: {image.path}.')
-    except ValueError:
-        messagebox.showerror('Image save error',
-            'The image could not be saved since ' \
-                'it does not have a valid filename.')
+    # Full resolution image must be decoded and built before saving
+    finish_decode()
+    finish_build()
+
+    start_save(image.path)
 
 def save_image_as_button_click():
     """Opens filedialog and saves the image to selected path."""
@@ -198,23 +444,124 @@ def save_image_as_button_click():
                 ('All', '*')), defaultextension='.png')
 
     if file_path != '':
-        # Try to save image, if it fails, show error message
-        try:
-            image.save(file_path)
-        except IOError:
-            messagebox.showerror('Image save error',
-                f'The image could not be saved at path: {file_path}.')
-        except ValueError:
-            messagebox.showerror('Image save error',
-                'The image could not be saved since ' \
-                    'it does not have a valid filename.')
+        # Full resolution image must be decoded and built before saving
+        finish_decode()
+        finish_build()
+
+        start_save(file_path)
+
+def start_save(path):
+    """Saves the current image in the background, so encoding does not block the window."""
+    global save_count
+
+    # Images are never changed in place, so the current image can be
+    # encoded while filtering goes on, animations and multi-page images
+    # get the filters of the current image applied to every frame
+    if image.animated:
+        future = writer.submit(write_frames, image.path, path, image.history.pipeline())
+    else:
+        future = writer.submit(write_image, image.current, path)
+    save_count += 1
+
+    # Starts save bar animation and checks for the result from the GUI thread
+    save_bar.start(10)
+    window.after(POLL_INTERVAL, check_save, future, path)
+
+def write_image(current_image, path):
+    """Saves an image as one trace, run in the background."""
+    with tracer.trace('save'):
+        save_image(current_image, path, save_options)
+
+def write_frames(image_path, path, pipeline):
+    """Saves every frame of an image file with a pipeline applied as one trace."""
+    with tracer.trace('save'):
+        filter_frames(image_path, path, pipeline, save_options=save_options)
+
+def check_save(future, path):
+    """Shows an error message if a background save failed, once it is done."""
+    global save_count
+
+    if not future.done():
+        window.after(POLL_INTERVAL, check_save, future, path)
+        return
+
+    # Stops save bar animation once every save is done
+    save_count -= 1
+    if save_count == 0:
+        save_bar.stop()
+
+    # If save failed, show error message
+    try:
+        future.result()
+    except IOError:
+        messagebox.showerror('Image save error',
+            f'The image could not be saved at path: {path}.')
+    except ValueError:
+        messagebox.showerror('Image save error',
+            'The image could not be saved since ' \
+                'it does not have a valid filename.')
+    # Encoders can also fail with errors of their own
+    except Exception as exc:
+        messagebox.showerror('Image save error',
+            f'The image could not be saved at path: {path}: {exc}')
+    else:
+        update_trace_text('save')
 
 if __name__ == '__main__':
-    # Creates image object and global variables
-    image = PILImage()
+    # Starts worker pool before the GUI so workers are not forked from Tk,
+    # pool size, start method and tile size can be set through environment variables
+    executor = FilterExecutor(int(os.environ.get('IMAGE_FILTERS_WORKERS', 0)) or None,
+        os.environ.get('IMAGE_FILTERS_START_METHOD'),
+        int(os.environ.get('IMAGE_FILTERS_TILE_SIZE', 0)) or tiling.TILE_SIZE)
+
+    # Builds run in this process or on the pool, with the worker count and tile size
+    # predicted to be fastest from a calibration kept per machine in a file that can
+    # be set through an environment variable
+    planner = ExecutionPlanner(executor,
+        os.environ.get('IMAGE_FILTERS_PLANNER_CACHE') or PLANNER_CACHE)
+    planner.calibrate()
+
+    # Traces of every stage can be logged as JSON lines, and the first
+    # full resolution build can be profiled, through environment variables
+    if os.environ.get('IMAGE_FILTERS_TRACE_LOG'):
+        tracer.open_log(os.environ['IMAGE_FILTERS_TRACE_LOG'])
+    if os.environ.get('IMAGE_FILTERS_PROFILE'):
+        tracer.profile_next(os.environ['IMAGE_FILTERS_PROFILE'], 'build')
+
+    # Creates image object and global variables, the memory budget of
+    # the image history in MB can be set through an environment variable
+    history_budget = int(os.environ.get('IMAGE_FILTERS_HISTORY_MB', 0)) * 1024 ** 2 or \
+        HISTORY_BUDGET
+    # Built images can be kept in a result cache on disk, enabled by setting its
+    # directory and optionally its size in MB through environment variables
+    result_cache = None
+    if os.environ.get('IMAGE_FILTERS_CACHE_DIR'):
+        result_cache = ResultCache(os.environ['IMAGE_FILTERS_CACHE_DIR'],
+            int(os.environ.get('IMAGE_FILTERS_CACHE_MB', 0)) * 1024 ** 2 or CACHE_BUDGET)
+
+    image = PILImage(history_budget, result_cache)
     image_tk = None
+    shown_image = None
+    shown_preview = None
     current_filter = None
 
+    # Filters are applied to the whole image or to a region selected on the preview
+    region = None
+    region_start = None
+
+    # Full resolution images are built one at a time in a background thread
+    background = ThreadPoolExecutor(max_workers=1)
+    build_job = None
+    decode_job = None
+    preview_job = None
+
+    # Images are saved one at a time in another background thread, with encoder
+    # options such as 'png.compress_level=1,jpeg.quality=85' set through an
+    # environment variable
+    writer = ThreadPoolExecutor(max_workers=1)
+    save_options = parse_save_options(os.environ.get('IMAGE_FILTERS_SAVE_OPTIONS', ''))
+    save_count = 0
+
     # GUI
     # Window
     window = tk.Tk()
@@ -230,6 +577,10 @@ if __name__ == '__main__':
     top_frame_separator.pack(side='bottom', fill='x')
 
     image_label = ttk.Label(top_frame, relief='solid')
+    image_label.bind('<ButtonPress-1>', start_region)
+    image_label.bind('<B1-Motion>', drag_region)
+    image_label.bind('<ButtonRelease-1>', finish_region)
+    image_label.bind('<Button-3>', clear_region)
 
     # Bottom frame
     bottom_frame = tk.Frame(window, bg='white')
@@ -240,16 +591,9 @@ if __name__ == '__main__':
     bottom_left_frame.pack(side='left', fill='both', expand=True)
 
     filter_list = ttk.Treeview(bottom_left_frame, selectmode='none', height=8)
-    filter_list.heading('#0', text='Filters (9)')
-    filter_list.insert('', 'end', text='Grayscale')
-    filter_list.insert('', 'end', text='Invert')
-    filter_list.insert('', 'end', text='Black and white')
-    filter_list.insert('', 'end', text='Sepia')
-    filter_list.insert('', 'end', text='Cold')
-    filter_list.insert('', 'end', text='Warm')
-    filter_list.insert('', 'end', text='Colorful')
-    filter_list.insert('', 'end', text='Lighter (1-10)')
-    filter_list.insert('', 'end', text='Darker (1-10)')
+    filter_list.heading('#0', text=f'Filters ({len(FILTERS)})')
+    for filter_traits in FILTER_TRAITS.values():
+        filter_list.insert('', 'end', iid=filter_traits.name, text=filter_traits.label)
     filter_list.bind('<<TreeviewSelect>>', lambda event: change_filter())
     filter_list.pack()
 
@@ -269,7 +613,18 @@ if __name__ == '__main__':
 
     intensity_slider = ttk.Scale(bottom_center_frame, from_=1, to=10, orient='horizontal',
         state='disabled', value=1, style='TScale', command=change_intensity)
-    intensity_slider.place(relx=0.5, rely=0.5, anchor='center')
+    intensity_slider.place(relx=0.5, rely=0.4, anchor='center')
+
+    # Style for live preview check button
+    style.configure('TCheckbutton', background='white')
+
+    live_preview = tk.BooleanVar(value=True)
+    live_preview_button = ttk.Checkbutton(bottom_center_frame, text='Live preview',
+        variable=live_preview, command=request_live_preview, style='TCheckbutton')
+    live_preview_button.place(relx=0.5, rely=0.65, anchor='center')
+
+    region_text = tk.Label(bottom_center_frame, text='Region: whole image', bg='white')
+    region_text.place(relx=0.5, rely=0.88, anchor='center')
 
     # Bottom right frame
     bottom_right_frame = tk.Frame(bottom_frame)
@@ -328,7 +683,25 @@ if __name__ == '__main__':
     status_text.pack()
 
     status_bar = ttk.Progressbar(bottom_right_bottom_frame, orient='horizontal',
-        mode='indeterminate', length=300)
+        mode='determinate', maximum=100, length=300)
     status_bar.pack(pady=10)
 
+    save_bar = ttk.Progressbar(bottom_right_bottom_frame, orient='horizontal',
+        mode='indeterminate', length=300)
+    save_bar.pack()
+
+    trace_text = tk.Label(bottom_right_bottom_frame, text='', bg='white', wraplength=300,
+        justify='left')
+    trace_text.pack()
+
+    memory_text = tk.Label(bottom_right_bottom_frame, text='History memory: 0.0 MB', bg='white')
+    memory_text.pack()
+
     window.mainloop()
+
+    # Stops background builds and worker pool when the window is closed,
+    # saves that were started are finished first
+    cancel_build()
+    background.shutdown()
+    writer.shutdown()
+    executor.close()
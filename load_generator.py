@@ -0,0 +1,181 @@
+"""Load generator for the filtering service, run against it on this machine.
+
+Example:
+    python load_generator.py --spawn --clients 32 --duration 10
+    python load_generator.py --port 8080 --clients 8 --sizes 0.01,1 --filters sepia
+"""
+import argparse
+import asyncio
+import io
+import json
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+from benchmark import generate_image
+from service import HOST, PORT, percentile, read_message, write_message
+
+# Seconds a spawned service has to start listening
+SPAWN_TIMEOUT = 30
+
+def encode_image(megapixels, image_format, seed=0):
+    """Returns a generated RGB image of a given size encoded in a format."""
+    output = io.BytesIO()
+    generate_image(megapixels, 'RGB', seed).save(output, image_format)
+    return output.getvalue()
+
+async def request(reader, writer, method, target, body=b''):
+    """Sends an HTTP request over an open connection, returns the status and response body."""
+    write_message(writer, f'{method} {target} HTTP/1.1', {'Host': HOST}, body)
+    await writer.drain()
+
+    message = await read_message(reader, max_body=sys.maxsize)
+    if message is None:
+        raise ConnectionError('Service closed the connection')
+
+    start_line, _, content = message
+    return int(start_line.split(' ')[1]), content
+
+async def run_client(host, port, target, bodies, deadline, remaining, results):
+    """Sends requests over one connection until the deadline or the request count is reached.
+
+    Results get the status and latency of each request.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    index = 0
+
+    try:
+        while time.perf_counter() < deadline and remaining[0] != 0:
+            remaining[0] -= 1
+            start_time = time.perf_counter()
+            try:
+                status, _ = await request(reader, writer, 'POST', target,
+                    bodies[index % len(bodies)])
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # Connections closed by the service are opened again
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+                status = 'closed'
+
+            results.append((status, time.perf_counter() - start_time))
+            index += 1
+    finally:
+        writer.close()
+
+async def fetch_stats(host, port):
+    """Returns the statistics reported by the service."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        _, content = await request(reader, writer, 'GET', '/stats')
+    finally:
+        writer.close()
+    return json.loads(content)
+
+async def run_load(host, port, target, bodies, clients, duration, request_count):
+    """Runs concurrent clients against the service, returns the results and the service stats."""
+    results = []
+    deadline = time.perf_counter() + duration
+    remaining = [request_count or -1]
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(run_client(host, port, target, bodies[client:] + bodies[:client],
+        deadline, remaining, results) for client in range(clients)))
+    elapsed = time.perf_counter() - start_time
+
+    return results, elapsed, await fetch_stats(host, port)
+
+def free_port():
+    """Returns a port on this machine that nothing listens on."""
+    with socket.socket() as free_socket:
+        free_socket.bind((HOST, 0))
+        return free_socket.getsockname()[1]
+
+def spawn_service(port, service_arguments):
+    """Starts the service in a new process and waits until it listens on a port.
+
+    The output of the service goes to stderr, so it is kept apart from the results.
+    """
+    process = subprocess.Popen([sys.executable, str(Path(__file__).with_name('service.py')),
+        '--port', str(port)] + service_arguments, stdout=sys.stderr)
+
+    deadline = time.perf_counter() + SPAWN_TIMEOUT
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    process.terminate()
+    raise RuntimeError(f'Service did not start listening on port {port}')
+
+def report(results, elapsed, stats):
+    """Returns the throughput, status counts and latency percentiles of a run."""
+    latencies = sorted(latency * 1000 for _, latency in results)
+    return {
+        'requests': len(results),
+        'seconds': elapsed,
+        'requests_per_second': len(results) / elapsed if elapsed else None,
+        'responses': {str(status): count for status, count in
+            Counter(status for status, _ in results).items()},
+        'latency_ms': {f'p{percent}': percentile(latencies, percent)
+            for percent in (50, 90, 99)},
+        'service': stats
+    }
+
+def main(arguments=None):
+    """Parses command line arguments and runs the load against the service."""
+    parser = argparse.ArgumentParser(description='Send load to the filtering service.')
+    parser.add_argument('--host', default=HOST, help=f'address of the service (default: {HOST})')
+    parser.add_argument('-p', '--port', type=int, default=PORT,
+        help=f'port of the service (default: {PORT})')
+    parser.add_argument('--spawn', action='store_true',
+        help='start the service on a free port for the run')
+    parser.add_argument('--service-args', default='',
+        help="arguments for the spawned service, e.g. '--workers 2 --queue 8'")
+    parser.add_argument('-c', '--clients', type=int, default=16,
+        help='number of concurrent connections (default: 16)')
+    parser.add_argument('-d', '--duration', type=float, default=10,
+        help='seconds to send requests for (default: 10)')
+    parser.add_argument('-n', '--requests', type=int,
+        help='number of requests to send, stops before the duration if reached')
+    parser.add_argument('--sizes', default='0.01,0.1',
+        help='comma separated image sizes in megapixels, sent in turn (default: 0.01,0.1)')
+    parser.add_argument('--format', default='PNG', help='format of sent images (default: PNG)')
+    parser.add_argument('--filters', default='sepia,lighter:3',
+        help="recipe to apply (default: 'sepia,lighter:3')")
+    parser.add_argument('--output', help='JSON file to write results to')
+    arguments = parser.parse_args(arguments)
+
+    bodies = [encode_image(float(size), arguments.format, seed)
+        for seed, size in enumerate(arguments.sizes.split(','))]
+    target = f'/filter?filters={arguments.filters}'
+
+    process = None
+    host, port = arguments.host, arguments.port
+    if arguments.spawn:
+        host, port = HOST, free_port()
+        process = spawn_service(port, arguments.service_args.split())
+
+    try:
+        results, elapsed, stats = asyncio.run(run_load(host, port, target, bodies,
+            arguments.clients, arguments.duration, arguments.requests))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if arguments.output:
+        with open(arguments.output, 'w', encoding='utf-8') as output:
+            json.dump(report(results, elapsed, stats), output, indent=2, sort_keys=True)
+    else:
+        json.dump(report(results, elapsed, stats), sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
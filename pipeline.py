@@ -0,0 +1,279 @@
+"""This module contains the FilterPipeline class."""
+import numpy as np
+from PIL import Image
+
+from filters import (COMPACT_MODES, FILTER_TRAITS, FILTERS, apply_palette, check_mode,
+    compile_lut, filter_pixels, to_filter_mode)
+
+def gray_ramp():
+    """Returns a pixel array of one row holding every gray value in all three channels."""
+    return np.repeat(np.arange(256, dtype=np.uint8)[np.newaxis, :, np.newaxis], 3, axis=2)
+
+def is_gray(tables, values):
+    """Checks if the lookup tables of all channels agree on the given values."""
+    return (tables[:, values] == tables[0, values]).all()
+
+def compact_image(gray_image, alpha_image):
+    """Creates an L, LA or 1 image from a gray band and an optional alpha band.
+
+    Gray bands holding only black and white without alpha give 1 images.
+    """
+    if alpha_image is not None:
+        return Image.merge('LA', (gray_image, alpha_image))
+
+    # Black and white values are kept exactly, as no dithering is done
+    if not any(gray_image.histogram()[1:255]):
+        return gray_image.convert('1', dither=Image.Dither.NONE)
+
+    return gray_image
+
+def compact_gray(current_image):
+    """Returns an RGB or RGBA image as an L, LA or 1 image if every pixel is gray.
+
+    Filters adding color followed by filters removing it again leave gray pixels
+    in a color image, which is then compacted the same way whether or not the
+    filters were fused into one pass.
+    """
+    # Most color images already have a pixel that is not gray in their first row,
+    # which is checked before copying the whole image to an array
+    for rows in (current_image.crop((0, 0, current_image.width, 1)), current_image):
+        pixels = np.asarray(rows)
+        if not ((pixels[..., 0] == pixels[..., 1]) & (pixels[..., 0] == pixels[..., 2])).all():
+            return current_image
+
+    alpha_image = current_image.getchannel('A') if current_image.mode == 'RGBA' else None
+    return compact_image(current_image.getchannel(0), alpha_image)
+
+class ChannelMap:
+    """This class contains a channel reordering followed by a lookup table per channel."""
+    def __init__(self, order=(0, 1, 2), tables=None):
+        self.order = tuple(order)
+        if tables is None:
+            tables = np.repeat(np.arange(256, dtype=np.uint8)[np.newaxis], 3, axis=0)
+        self.tables = tables
+
+    @classmethod
+    def from_filter(cls, image_filter, intensity):
+        """Creates a channel map from a per-channel or channel reordering filter."""
+        traits = FILTER_TRAITS[image_filter]
+        if traits.channel_order is not None:
+            return cls(order=traits.channel_order)
+
+        table = compile_lut(traits.kernel, intensity, 3)
+        return cls(tables=np.array(table, dtype=np.uint8).reshape(3, 256))
+
+    def is_identity(self):
+        """Checks if the channel map leaves every pixel unchanged."""
+        return self.order == (0, 1, 2) and (
+            self.tables == np.arange(256, dtype=np.uint8)).all()
+
+    def then(self, other):
+        """Returns a channel map doing this channel map followed by another one."""
+        order = tuple(self.order[index] for index in other.order)
+        tables = np.stack([other.tables[channel][self.tables[other.order[channel]]]
+            for channel in range(3)])
+        return ChannelMap(order, tables)
+
+    def __call__(self, channels, intensity=1):
+        """Applies the channel map to a pixel array."""
+        return np.stack([self.tables[channel][channels[..., self.order[channel]]]
+            for channel in range(3)], axis=2)
+
+class FusedStage:
+    """This class contains filters collapsed into a single pass over the pixels.
+
+    A pass is a channel map, then at most one channel mixing kernel, then another
+    channel map. Clamping happens inside each part exactly as the filters do it.
+    Passes whose kernel reads neighbouring pixels have a radius and can't be split
+    into tiles.
+    """
+    def __init__(self):
+        self.before = ChannelMap()
+        self.kernel = None
+        self.after = ChannelMap()
+        self.single_channel = False
+        self.binary = False
+        self.radius = 0
+        self.filters = []
+
+    def add(self, image_filter, intensity):
+        """Folds a filter into the pass, returns False if it needs a new pass."""
+        traits = FILTER_TRAITS[image_filter]
+        if traits.per_channel or traits.channel_order is not None:
+            channel_map = ChannelMap.from_filter(image_filter, intensity)
+            if self.kernel is None:
+                self.before = self.before.then(channel_map)
+            else:
+                self.after = self.after.then(channel_map)
+
+        elif self.kernel is None:
+            self.kernel = (traits.kernel, intensity)
+            self.single_channel = traits.single_channel
+            self.binary = traits.binary
+            self.radius = traits.radius
+
+        elif self.single_channel and not traits.radius:
+            # Every channel holds the same value here, so running the kernel over
+            # the output of all 256 values gives a new lookup table per channel
+            kernel = traits.kernel
+            values = self.after(gray_ramp())
+            tables = np.broadcast_to(kernel(values, intensity), values.shape)[0].T
+            self.after = ChannelMap(tables=np.ascontiguousarray(tables))
+
+        else:
+            return False
+
+        self.filters.append((image_filter, intensity))
+        return True
+
+    def __call__(self, channels, intensity=1):
+        """Runs the pass over a pixel array."""
+        if not self.before.is_identity():
+            channels = self.before(channels)
+        if self.kernel is not None:
+            kernel, kernel_intensity = self.kernel
+            channels = np.broadcast_to(kernel(channels, kernel_intensity), channels.shape)
+        if not self.after.is_identity():
+            channels = self.after(channels)
+        return channels
+
+    def kernel_values(self):
+        """Returns the values the kernel of the pass can leave for the channel map after it."""
+        # Binary kernels only leave black and white
+        if self.binary:
+            return np.array([0, 255])
+        return np.arange(256)
+
+    def gray_output(self):
+        """Checks if the pass leaves the same value in every channel of any RGB or RGBA image."""
+        return self.single_channel and is_gray(self.after.tables, self.kernel_values())
+
+    def apply(self, current_image):
+        """Runs the pass over an RGB, RGBA, L, LA, 1 or P image.
+
+        Results with the same value in every channel are returned as L, LA or 1 images,
+        P images stay P images with a new palette.
+        """
+        # Kernels reading neighbouring pixels are no function of one gray value or
+        # palette entry, so compact and P images are expanded for them
+        if current_image.mode in COMPACT_MODES and self.radius:
+            current_image = current_image.convert(COMPACT_MODES[current_image.mode])
+        elif current_image.mode in COMPACT_MODES:
+            return self.apply_compact(current_image)
+        elif current_image.mode == 'P' and self.radius:
+            current_image = to_filter_mode(current_image)
+        elif current_image.mode == 'P':
+            return apply_palette(current_image, self, 1)
+
+        # Lookup table only passes can be run by Pillow without copying to an array
+        if self.kernel is None and self.before.order == (0, 1, 2):
+            table = self.before.tables.ravel().tolist()
+            if current_image.mode == 'RGBA':
+                table += list(range(256))
+            return compact_gray(current_image.point(table))
+
+        pixels = np.asarray(current_image)
+        if not self.gray_output():
+            return compact_gray(Image.fromarray(filter_pixels(pixels, self, 1)))
+
+        # Gray results only need the first channel computed
+        channels = pixels[..., :3]
+        if not self.before.is_identity():
+            channels = self.before(channels)
+        kernel, kernel_intensity = self.kernel
+        values = np.broadcast_to(kernel(channels, kernel_intensity), channels.shape)[..., 0]
+        gray_image = Image.fromarray(np.ascontiguousarray(self.after.tables[0][values]))
+        alpha_image = current_image.getchannel('A') if current_image.mode == 'RGBA' else None
+        return compact_image(gray_image, alpha_image)
+
+    def apply_compact(self, current_image):
+        """Runs the pass over an L, LA or 1 image through a lookup table per channel."""
+        if current_image.mode == '1':
+            current_image = current_image.convert('L')
+
+        # Every channel holds the gray value, so the pass is a function of that one value,
+        # only the values found in the image decide if the result stays gray
+        tables = np.ascontiguousarray(np.broadcast_to(self(gray_ramp()), (1, 256, 3))[0].T)
+        gray_image = current_image.getchannel(0)
+        values = np.flatnonzero(gray_image.histogram())
+
+        # Results that stay gray keep a single channel
+        if is_gray(tables, values):
+            if current_image.mode == 'LA':
+                return current_image.point(tables[0].tolist() + list(range(256)))
+            return compact_image(current_image.point(tables[0].tolist()), None)
+
+        # Other results expand to color, one lookup table per channel
+        bands = [gray_image.point(table.tolist()) for table in tables]
+        return Image.merge(COMPACT_MODES[current_image.mode],
+            bands + list(current_image.split()[1:]))
+
+class FilterPipeline:
+    """This class records a sequence of filters and applies them in as few passes as possible."""
+    def __init__(self, steps=()):
+        self.steps = []
+        for image_filter, intensity in steps:
+            self.add(image_filter, intensity)
+
+    @classmethod
+    def parse(cls, recipe):
+        """Creates a pipeline from a recipe such as 'sepia,lighter:3'."""
+        pipeline = cls()
+
+        for step in recipe.split(','):
+            name, _, intensity = step.strip().partition(':')
+            if name not in FILTERS:
+                raise ValueError(f'Unknown filter: {name}')
+
+            try:
+                pipeline.add(FILTERS[name], int(intensity or 1))
+            except ValueError as exc:
+                raise ValueError(f'Invalid recipe step: {step.strip()}') from exc
+
+        return pipeline
+
+    def recipe(self):
+        """Returns the recipe of the pipeline, as accepted by parse."""
+        names = {image_filter: traits.name for image_filter, traits in FILTER_TRAITS.items()}
+        return ','.join(names[image_filter] if intensity == 1 else
+            f'{names[image_filter]}:{intensity:g}' for image_filter, intensity in self.steps)
+
+    def add(self, image_filter, intensity=1):
+        """Adds a filter to the end of the pipeline."""
+        if image_filter not in FILTER_TRAITS:
+            raise ValueError(f'Unknown filter: {image_filter}')
+        if not FILTER_TRAITS[image_filter].uses_intensity and intensity != 1:
+            raise ValueError(f'{image_filter.__name__} does not use the intensity slider')
+
+        self.steps.append((image_filter, intensity))
+        return self
+
+    def radius(self):
+        """Returns how far the filters of the pipeline read around each pixel."""
+        return max((FILTER_TRAITS[image_filter].radius for image_filter, _ in self.steps),
+            default=0)
+
+    def compile(self):
+        """Collapses the recorded filters into fused passes."""
+        stages = []
+
+        for image_filter, intensity in self.steps:
+            if not stages or not stages[-1].add(image_filter, intensity):
+                stages.append(FusedStage())
+                stages[-1].add(image_filter, intensity)
+
+        return stages
+
+    def apply(self, current_image):
+        """Applies all recorded filters to an RGB, RGBA, L, LA, 1 or P image.
+
+        Results with the same value in every channel are kept as L, LA or 1 images,
+        P images stay P images with a new palette.
+        """
+        if current_image.mode not in COMPACT_MODES and current_image.mode != 'P':
+            check_mode(current_image)
+
+        for stage in self.compile():
+            current_image = stage.apply(current_image)
+
+        return current_image
@@ -0,0 +1,410 @@
+"""This module contains the ExecutionPlanner class, which picks how each job is run.
+
+Jobs run in this process or on the worker pool, with a number of workers and a
+tile size. The overheads and scaling of the pool are calibrated once per machine
+and each pipeline is measured on a small image the first time it is seen. Both
+are kept in a JSON file, and the time of every option is then predicted from
+the pixel count of the job.
+
+Example, checking the planner against every option on a sweep of image sizes:
+    python planner.py --sides 64,256,1024,4096,10000 --filters sepia,lighter:3
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from multiprocessing import cpu_count
+from threading import Lock
+
+import numpy as np
+import PIL
+from PIL import Image
+
+import tiling
+from executor import FilterExecutor
+from filters import COMPACT_MODES, check_mode, filter_pixels
+from image import atomic_file
+from pipeline import FilterPipeline
+from tracing import tracer
+
+# Default file calibrations are kept in, by machine
+PLANNER_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'image_filters', 'planner.json')
+
+# Tile sizes in bytes the planner chooses from
+TILE_SIZES = (tiling.TILE_SIZE // 4, tiling.TILE_SIZE, tiling.TILE_SIZE * 4)
+
+# Recipe the pool is calibrated with, a channel mixing pass over every pixel
+CALIBRATION_RECIPE = 'sepia'
+
+# Megapixels of the image the scaling of the pool is calibrated on
+CALIBRATION_MEGAPIXELS = 2
+
+# Side in pixels of the images pipelines are measured on
+PIPELINE_SIDE = 384
+
+# Version of the kept calibrations, calibrations of other versions are measured again
+CALIBRATION_VERSION = 3
+
+# Runs per measurement, the fastest one is kept
+REPEAT = 3
+
+# Measured pipelines kept per machine, the oldest are measured again when needed
+PIPELINE_LIMIT = 256
+
+def best_times(functions, repeat=REPEAT):
+    """Returns the fastest wall time in seconds of a number of calls to each function.
+
+    Functions are called in turn, so a machine getting slower or faster while they
+    are measured affects all of them alike.
+    """
+    seconds = [float('inf')] * len(functions)
+    for _ in range(repeat):
+        for index, function in enumerate(functions):
+            start_time = time.perf_counter()
+            function()
+            seconds[index] = min(seconds[index], time.perf_counter() - start_time)
+    return seconds
+
+def best_time(function, repeat=REPEAT):
+    """Returns the fastest wall time in seconds of a number of calls to a function."""
+    return best_times([function], repeat)[0]
+
+def worker_counts(processes):
+    """Returns the worker counts the planner chooses from, powers of two up to the pool size."""
+    counts = [1]
+    while counts[-1] * 2 < processes:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != processes:
+        counts.append(processes)
+    return counts
+
+def calibration_image(size, mode, seed=0):
+    """Creates an image of random pixels of a given size and mode."""
+    pixels = np.random.default_rng(seed).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    current_image = Image.fromarray(pixels)
+    return current_image if mode == 'RGB' else current_image.convert(mode)
+
+class Plan:
+    """This class contains how a job is run, in this process or on the worker pool with a
+    number of workers and a tile size, and the seconds it is predicted to take."""
+    def __init__(self, path, workers=1, tile_size=None, seconds=0.0):
+        self.path = path
+        self.workers = workers
+        self.tile_size = tile_size
+        self.seconds = seconds
+
+    def __str__(self):
+        if self.path == 'serial':
+            return 'serial'
+        return f'{self.workers} workers, {self.tile_size // 1024} KiB tiles'
+
+class ExecutionPlanner:
+    """This class contains the calibration of this machine and the pipelines measured on it,
+    and runs each job the way it predicts to be fastest."""
+    def __init__(self, executor, cache_path=PLANNER_CACHE):
+        self.executor = executor
+        self.cache_path = cache_path
+        self.machine = None
+        self.pipelines = {}
+
+        # Pipelines are measured and kept from the thread running the job
+        self.lock = Lock()
+
+    def machine_key(self):
+        """Returns what the calibration depends on: the machine, library versions and pool."""
+        return ' '.join((f'version={CALIBRATION_VERSION}', platform.node(), platform.machine(),
+            platform.python_version(), f'numpy={np.__version__}', f'pillow={PIL.__version__}',
+            f'cpus={cpu_count()}',
+            f'workers={self.executor.processes}',
+            f'oversubscription={self.executor.oversubscription}',
+            f'square={self.executor.square}'))
+
+    def load(self):
+        """Returns the calibrations kept in the cache file, by machine."""
+        try:
+            with open(self.cache_path, encoding='utf-8') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        """Keeps the calibration and measured pipelines of this machine in the cache file."""
+        if self.cache_path is None:
+            return
+
+        calibrations = self.load()
+        calibrations[self.machine_key()] = {'machine': self.machine, 'pipelines': self.pipelines}
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            with atomic_file(self.cache_path, 'x') as cache_file:
+                json.dump(calibrations, cache_file, indent=2)
+        except OSError:
+            pass
+
+    def calibrate(self, force=False):
+        """Loads the calibration of this machine, measuring it if none is kept or if forced."""
+        calibration = None if force else self.load().get(self.machine_key())
+        if calibration is not None:
+            self.machine = calibration['machine']
+            self.pipelines = calibration['pipelines']
+            return
+
+        with tracer.trace('calibrate'):
+            self.machine = self.measure_machine()
+            self.pipelines = {}
+        self.save()
+
+    def measure_machine(self):
+        """Measures the fixed, per tile and copy costs of the pool and how it scales."""
+        pipeline = FilterPipeline.parse(CALIBRATION_RECIPE)
+        apply_pipeline = self.executor.apply_pipeline
+
+        # Jobs on the pool pay a fixed cost, and each tile of each pass costs more,
+        # measured by splitting a small image into a tile for each row
+        small_image = calibration_image((64, 64), 'RGB')
+        fixed, many_seconds = best_times([
+            lambda: apply_pipeline(small_image, pipeline, workers=1),
+            lambda: apply_pipeline(small_image, pipeline, workers=1,
+                tile_size=small_image.width * 3)])
+        few_tiles = len(tiling.split(small_image.size, 3, 1, tiling.TILE_SIZE,
+            self.executor.oversubscription, self.executor.square))
+        many_tiles = len(tiling.split(small_image.size, 3, 1, small_image.width * 3,
+            self.executor.oversubscription, self.executor.square))
+        tile = max(many_seconds - fixed, 0) / max(many_tiles - few_tiles, 1)
+
+        # Images are copied into and out of shared memory
+        side = int((CALIBRATION_MEGAPIXELS * 1_000_000) ** 0.5)
+        image = calibration_image((side, side), 'RGB')
+        buffer = np.empty((side, side, 3), dtype=np.uint8)
+        copy = best_time(lambda: (np.copyto(buffer, np.asarray(image)),
+            Image.frombytes('RGB', image.size, buffer.tobytes()))) / buffer.nbytes
+
+        # Whole images no longer fit in the CPU cache, so filtering them in this process
+        # costs more per pixel than filtering the images pipelines are measured on
+        pixels = np.asarray(image)
+        small_pixels = pixels[:PIPELINE_SIDE, :PIPELINE_SIDE]
+        stage = pipeline.compile()[0]
+        small_seconds, large_seconds = best_times([
+            lambda: filter_pixels(small_pixels, stage, 1), lambda: filter_pixels(pixels, stage, 1)])
+        small_seconds /= small_pixels.size
+        serial_scale = max(large_seconds / pixels.size / small_seconds, 1)
+
+        # Tile sizes change how well tiles stay in the CPU cache, and more workers
+        # share the tiles, both compared with one worker on the default tile size
+        options = [(1, tile_size) for tile_size in TILE_SIZES] + [(workers, tiling.TILE_SIZE)
+            for workers in worker_counts(self.executor.processes) if workers > 1]
+        seconds = best_times([lambda workers=workers, tile_size=tile_size: apply_pipeline(
+            image, pipeline, workers=workers, tile_size=tile_size)
+            for workers, tile_size in options])
+
+        # Kernel time on the pool is what is left once the other costs are taken off,
+        # workers beyond the planned count are left idle
+        kernel_seconds = {}
+        for (workers, tile_size), option_seconds in zip(options, seconds):
+            tile_count = len(tiling.split(image.size, 3, workers, tile_size,
+                self.executor.oversubscription, self.executor.square))
+            kernel_seconds[workers, tile_size] = max(option_seconds - fixed -
+                copy * buffer.nbytes * 2 - tile * tile_count, 1e-6)
+
+        base_seconds = kernel_seconds[1, tiling.TILE_SIZE]
+        tile_factors = {str(tile_size): kernel_seconds[1, tile_size] / base_seconds
+            for tile_size in TILE_SIZES}
+        speedups = {str(workers): base_seconds / kernel_seconds[workers, tiling.TILE_SIZE]
+            for workers in worker_counts(self.executor.processes)}
+
+        # Kernels on the pool cost more or less per pixel than measured in this process
+        kernel_scale = base_seconds / pixels.size / small_seconds
+
+        return {'fixed': fixed, 'tile': tile, 'copy': copy, 'tile_factors': tile_factors,
+            'speedups': speedups, 'kernel_scale': kernel_scale, 'serial_scale': serial_scale}
+
+    def serial_factor(self, pixel_count):
+        """Returns how much more a pixel costs in this process for images of a pixel count.
+
+        Costs grow from the pipeline measurement up to the calibration image size.
+        """
+        small_count = PIPELINE_SIDE * PIPELINE_SIDE
+        large_count = CALIBRATION_MEGAPIXELS * 1_000_000
+        share = min(max((pixel_count - small_count) / (large_count - small_count), 0), 1)
+        return 1 + (self.machine['serial_scale'] - 1) * share
+
+    def pipeline_cost(self, pipeline, mode):
+        """Returns the seconds per pixel of a pipeline on images of a mode, measuring it once.
+
+        Costs are split as the worker pool runs the pipeline: passes over single
+        channel and P images and passes with a radius run in this process, the
+        remaining passes run on the pool.
+        """
+        key = f'{mode} {pipeline.recipe()}'
+        with self.lock:
+            if key in self.pipelines:
+                return self.pipelines[key]
+
+        image = calibration_image((PIPELINE_SIDE, PIPELINE_SIDE), mode)
+        pixel_count = PIPELINE_SIDE * PIPELINE_SIDE
+        serial = best_time(lambda: pipeline.apply(image))
+
+        # Passes run in this process until one expands the image to color
+        stages = pipeline.compile()
+        in_process = 0
+        while stages and (image.mode in COMPACT_MODES or image.mode == 'P'):
+            stage = stages.pop(0)
+            in_process += best_time(lambda: stage.apply(image))
+            image = stage.apply(image)
+
+        kernel = 0
+        if stages:
+            pixels = np.asarray(image)
+            out = np.empty_like(pixels)
+            for stage in stages:
+                seconds = best_time(lambda: filter_pixels(pixels, stage, 1, out=out))
+                if stage.radius:
+                    in_process += seconds
+                else:
+                    kernel += seconds
+                pixels, out = out, pixels
+
+        cost = {'serial': serial / pixel_count, 'in_process': in_process / pixel_count,
+            'kernel': kernel / pixel_count,
+            'passes': sum(not stage.radius for stage in stages)}
+        with self.lock:
+            self.pipelines[key] = cost
+            while len(self.pipelines) > PIPELINE_LIMIT:
+                del self.pipelines[next(iter(self.pipelines))]
+            self.save()
+        return cost
+
+    def predict(self, size, mode, pipeline):
+        """Returns every plan for a job, with the seconds each is predicted to take."""
+        cost = self.pipeline_cost(pipeline, mode)
+        pixel_count = size[0] * size[1]
+        plans = [Plan('serial',
+            seconds=cost['serial'] * pixel_count * self.serial_factor(pixel_count))]
+
+        # Pipelines that never reach the pool run in this process either way
+        if not cost['passes']:
+            return plans
+
+        machine = self.machine
+        bytes_per_pixel = 4 if 'A' in mode or mode == 'P' else 3
+        for workers in worker_counts(self.executor.processes):
+            for tile_size in TILE_SIZES:
+                tile_count = len(tiling.split(size, bytes_per_pixel, workers, tile_size,
+                    self.executor.oversubscription, self.executor.square))
+                seconds = machine['fixed'] + \
+                    machine['copy'] * pixel_count * bytes_per_pixel * 2 + \
+                    cost['in_process'] * pixel_count + \
+                    cost['passes'] * machine['tile'] * tile_count + \
+                    cost['kernel'] * pixel_count * machine['kernel_scale'] * \
+                    machine['tile_factors'][str(tile_size)] / \
+                    machine['speedups'][str(workers)]
+                plans.append(Plan('pool', workers, tile_size, seconds))
+
+        return plans
+
+    def plan(self, size, mode, pipeline):
+        """Returns the plan predicted to run a job fastest and notes it in the current trace."""
+        if self.machine is None:
+            self.calibrate()
+
+        plan = min(self.predict(size, mode, pipeline), key=lambda plan: plan.seconds)
+        tracer.note(plan=str(plan), predicted_ms=plan.seconds * 1000, size=list(size), mode=mode,
+            recipe=pipeline.recipe())
+        return plan
+
+    def run(self, plan, current_image, pipeline, cancelled=None, progress=None, tiles=None):
+        """Runs a job as planned, see FilterExecutor.apply_pipeline.
+
+        Serial jobs check for a cancel between passes and report progress per pass.
+        """
+        if plan.path == 'pool':
+            return self.executor.apply_pipeline(current_image, pipeline, cancelled, progress,
+                tiles, plan.workers, plan.tile_size)
+
+        if current_image.mode not in COMPACT_MODES and current_image.mode != 'P':
+            check_mode(current_image)
+
+        stages = pipeline.compile()
+        with tracer.stage('filter', current_image.width * current_image.height):
+            for stage_index, stage in enumerate(stages):
+                if cancelled is not None and cancelled.is_set():
+                    return None
+                current_image = stage.apply(current_image)
+                if progress is not None:
+                    progress(stage_index + 1, len(stages))
+
+        return current_image
+
+    def apply_pipeline(self, current_image, pipeline, cancelled=None, progress=None, tiles=None):
+        """Applies a pipeline the way predicted to be fastest, see FilterExecutor.apply_pipeline."""
+        plan = self.plan(current_image.size, current_image.mode, pipeline)
+        return self.run(plan, current_image, pipeline, cancelled, progress, tiles)
+
+def sweep(planner, sides, mode, pipeline, repeat):
+    """Times every plan on square images of each side, returns how the chosen plan did."""
+    results = []
+
+    for side in sides:
+        current_image = calibration_image((side, side), mode, side)
+        chosen = planner.plan(current_image.size, mode, pipeline)
+
+        # Every option is timed, the chosen one is compared with the fastest
+        plans = planner.predict(current_image.size, mode, pipeline)
+        timings = list(zip(best_times([lambda plan=plan: planner.run(plan, current_image,
+            pipeline) for plan in plans], repeat), plans))
+        fastest_seconds, fastest = min(timings, key=lambda timing: timing[0])
+        chosen_seconds = next(seconds for seconds, plan in timings if str(plan) == str(chosen))
+
+        results.append({
+            'side': side,
+            'chosen': str(chosen),
+            'chosen_ms': chosen_seconds * 1000,
+            'predicted_ms': chosen.seconds * 1000,
+            'fastest': str(fastest),
+            'fastest_ms': fastest_seconds * 1000,
+            'slowdown': chosen_seconds / fastest_seconds
+        })
+
+    return results
+
+def main(arguments=None):
+    """Parses command line arguments and checks the planner on a sweep of image sizes."""
+    parser = argparse.ArgumentParser(description='Check the planner against every option.')
+    parser.add_argument('--sides', default='64,256,1024,4096,10000',
+        help='comma separated sides in pixels of the square images')
+    parser.add_argument('--mode', default='RGB', help='image mode (default: RGB)')
+    parser.add_argument('--filters', default='sepia,lighter:3',
+        help="recipe to apply (default: 'sepia,lighter:3')")
+    parser.add_argument('--workers', type=int, default=cpu_count(),
+        help='number of worker processes (default: CPU count)')
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+        help=f'runs per option, the fastest is kept (default: {REPEAT})')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+        help='slowdown over the fastest option allowed for noise (default: 0.1)')
+    parser.add_argument('--calibrate', action='store_true',
+        help='calibrate again instead of using the kept calibration')
+    parser.add_argument('--cache', default=PLANNER_CACHE,
+        help=f'file calibrations are kept in (default: {PLANNER_CACHE})')
+    arguments = parser.parse_args(arguments)
+
+    try:
+        pipeline = FilterPipeline.parse(arguments.filters)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    with FilterExecutor(arguments.workers) as executor:
+        planner = ExecutionPlanner(executor, arguments.cache)
+        planner.calibrate(arguments.calibrate)
+        results = sweep(planner, [int(side) for side in arguments.sides.split(',')],
+            arguments.mode, pipeline, arguments.repeat)
+
+    json.dump({'machine': planner.machine, 'results': results}, sys.stdout, indent=2)
+    print()
+
+    # Fails if a chosen plan was clearly slower than the fastest one
+    return 1 if any(result['slowdown'] > 1 + arguments.tolerance for result in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
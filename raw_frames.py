@@ -0,0 +1,215 @@
+"""Command line tool for filtering raw video frames piped through stdin and stdout.
+
+Example:
+    ffmpeg -i input.mp4 -f rawvideo -pix_fmt rgb24 - |
+        python raw_frames.py --size 1920x1080 --filters sepia,lighter:3 |
+        ffmpeg -f rawvideo -pix_fmt rgb24 -s 1920x1080 -i - output.mp4
+    python raw_frames.py --size 1920x1080 --generate 300 |
+        python raw_frames.py --size 1920x1080 --filters sepia > /dev/null
+
+Frames are read into a ring of shared buffers allocated once, filtered by worker
+processes several frames at a time and written in the order they were read.
+Frames per second are reported on stderr.
+"""
+import argparse
+import sys
+import time
+from collections import deque
+from multiprocessing import cpu_count, get_context, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from benchmark import generate_image
+from executor import attach_buffers
+from filters import filter_pixels
+from pipeline import FilterPipeline
+
+# Pixel formats of the frames, with the names ffmpeg gives them
+PIXEL_FORMATS = {'rgb24': 'RGB', 'rgba': 'RGBA', 'RGB': 'RGB', 'RGBA': 'RGBA'}
+
+# Frames in flight for each worker, so workers don't wait for reads and writes
+FRAMES_PER_WORKER = 2
+
+# Seconds between frame rate reports
+REPORT_INTERVAL = 5
+
+# Frame ring, frame shape and fused passes of a worker, set once when it starts
+worker_state = {}
+
+def start_worker(buffer_name, shape, stages):
+    """Keeps the frame ring, frame shape and fused passes for the frames of a worker."""
+    worker_state['buffer_name'] = buffer_name
+    worker_state['shape'] = shape
+    worker_state['stages'] = stages
+
+def filter_slot(slot):
+    """Runs the fused passes over the frame in a slot of the ring, run in a worker.
+
+    Each slot holds a frame and a scratch frame the passes alternate between.
+    Returns the index of the one holding the result.
+    """
+    buffer, = attach_buffers(worker_state['buffer_name'])
+    shape = worker_state['shape']
+    frames = np.ndarray((2,) + shape, dtype=np.uint8, buffer=buffer,
+        offset=slot * 2 * int(np.prod(shape)))
+
+    for index, stage in enumerate(worker_state['stages']):
+        filter_pixels(frames[index % 2], stage, 1, out=frames[(index + 1) % 2])
+
+    return len(worker_state['stages']) % 2
+
+def read_frame(input_file, frame):
+    """Reads a frame into a buffer, returns the number of bytes read before the input ended."""
+    filled = 0
+    while filled < len(frame):
+        count = input_file.readinto(frame[filled:])
+        if not count:
+            break
+        filled += count
+
+    return filled
+
+def filter_stream(input_file, output_file, size, mode, pipeline, workers=None, report=None):
+    """Applies a pipeline to raw frames read from a file and writes them in order to another.
+
+    Frames are filtered by a pool of worker processes, or in this process if
+    workers is 0. Report is called with the number of frames written and the
+    seconds since the first frame was read, at most every REPORT_INTERVAL seconds.
+    Returns the number of frames and the seconds spent on them.
+    """
+    workers = cpu_count() if workers is None else workers
+    shape = (size[1], size[0], len(mode))
+    frame_size = int(np.prod(shape))
+    stages = pipeline.compile()
+
+    # Every frame in flight has its own slot, so frames are never allocated while streaming
+    slot_count = max(workers, 1) * FRAMES_PER_WORKER
+    resource_tracker.ensure_running()
+    ring = SharedMemory(create=True, size=slot_count * 2 * frame_size)
+
+    pool = None
+    if workers:
+        pool = get_context().Pool(workers, start_worker, (ring.name, shape, stages))
+    else:
+        start_worker(ring.name, shape, stages)
+
+    try:
+        free_slots = deque(range(slot_count))
+        in_flight = deque()
+        frame_count = 0
+        start_time = report_time = time.perf_counter()
+        ended = False
+
+        while not ended or in_flight:
+            # The oldest frame is written once the ring is full or the input has ended
+            if not free_slots or ended:
+                slot, result = in_flight.popleft()
+                half = result.get() if pool is not None else result
+                offset = (slot * 2 + half) * frame_size
+                output_file.write(ring.buf[offset:offset + frame_size])
+                free_slots.append(slot)
+                frame_count += 1
+
+                if report is not None and time.perf_counter() - report_time >= REPORT_INTERVAL:
+                    report_time = time.perf_counter()
+                    report(frame_count, report_time - start_time)
+                continue
+
+            slot = free_slots.popleft()
+            offset = slot * 2 * frame_size
+            filled = read_frame(input_file, ring.buf[offset:offset + frame_size])
+            if filled < frame_size:
+                if filled:
+                    raise ValueError(f'Input ended inside a frame, after {filled} of '
+                        f'{frame_size} bytes')
+                ended = True
+                continue
+
+            if pool is not None:
+                in_flight.append((slot, pool.apply_async(filter_slot, (slot,))))
+            else:
+                in_flight.append((slot, filter_slot(slot)))
+
+        output_file.flush()
+        return frame_count, time.perf_counter() - start_time
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        attach_buffers()
+        ring.close()
+        ring.unlink()
+
+def generate_frames(output_file, size, mode, count):
+    """Writes a number of synthetic raw frames, a generated image moving to the left."""
+    width, height = size
+
+    # Frames are windows into an image twice as wide, copied into one reused frame
+    base = np.asarray(generate_image(width * height * 2 / 1_000_000, mode))
+    base = np.resize(base, (height, width * 2, len(mode)))
+    frame = np.empty((height, width, len(mode)), dtype=np.uint8)
+
+    for index in range(count):
+        offset = index * 8 % width
+        np.copyto(frame, base[:, offset:offset + width])
+        output_file.write(frame.data)
+
+    output_file.flush()
+
+def parse_size(text):
+    """Parses a frame size such as '1920x1080' into a width and height."""
+    width, _, height = text.partition('x')
+    try:
+        size = int(width), int(height)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f'Invalid frame size: {text}') from exc
+
+    if min(size) < 1:
+        raise argparse.ArgumentTypeError(f'Invalid frame size: {text}')
+    return size
+
+def main(arguments=None):
+    """Parses command line arguments and filters or generates raw frames."""
+    parser = argparse.ArgumentParser(description='Filter raw video frames from stdin to stdout.')
+    parser.add_argument('-s', '--size', type=parse_size, required=True,
+        help="frame size as WIDTHxHEIGHT, e.g. '1920x1080'")
+    parser.add_argument('--pix-fmt', default='rgb24', choices=PIXEL_FORMATS,
+        help='pixel format of the frames (default: rgb24)')
+    parser.add_argument('--filters', help="comma separated recipe, e.g. 'sepia,lighter:3'")
+    parser.add_argument('-w', '--workers', type=int, default=cpu_count(),
+        help='number of worker processes, 0 filters in this process (default: CPU count)')
+    parser.add_argument('--generate', type=int, metavar='COUNT',
+        help='write a number of synthetic frames instead of filtering')
+    arguments = parser.parse_args(arguments)
+    mode = PIXEL_FORMATS[arguments.pix_fmt]
+
+    if arguments.generate is not None:
+        generate_frames(sys.stdout.buffer, arguments.size, mode, arguments.generate)
+        return 0
+
+    if not arguments.filters:
+        parser.error('--filters is required unless frames are generated')
+    try:
+        pipeline = FilterPipeline.parse(arguments.filters)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    def report(frame_count, seconds):
+        print(f'{frame_count} frames, {frame_count / seconds:.1f} fps', file=sys.stderr)
+
+    try:
+        frame_count, seconds = filter_stream(sys.stdin.buffer, sys.stdout.buffer,
+            arguments.size, mode, pipeline, arguments.workers, report)
+    except (ValueError, BrokenPipeError) as exc:
+        print(f'Could not filter frames: {exc}', file=sys.stderr)
+        return 1
+
+    fps = frame_count / seconds if seconds else 0
+    print(f'Filtered {frame_count} frames in {seconds:.1f} s, {fps:.1f} fps with '
+        f'{arguments.workers} workers', file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
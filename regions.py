@@ -0,0 +1,195 @@
+"""This module contains the Region class, for applying filters to part of an image.
+
+Images are divided into a fixed grid of tiles. Only the tiles a region touches
+are filtered, and a history step applied to a region keeps only those tiles, as
+they were before and after the step. Filtering, undoing and redrawing a region
+then grow with its area instead of the image size, apart from copying the image.
+"""
+from math import ceil, floor
+
+from PIL import Image
+
+from filters import to_filter_mode
+
+# Side in pixels of the tiles of the grid regions are filtered and kept in
+REGION_TILE = 128
+
+class Region:
+    """This class contains a rectangle of an image and an optional mask inside it.
+
+    The mask is an L image of the size of the rectangle, pixels where it is 0 are
+    left unchanged and others are blended in as far as the mask value goes.
+    """
+    def __init__(self, box, mask=None):
+        left, upper, right, lower = box
+        if right <= left or lower <= upper:
+            raise ValueError(f'Empty region: {box}')
+        if mask is not None and mask.size != (right - left, lower - upper):
+            raise ValueError('Region mask must have the size of the region')
+
+        self.box = (left, upper, right, lower)
+        self.mask = mask if mask is None or mask.mode == 'L' else mask.convert('L')
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def key(self):
+        """Returns what decides the pixels of the region, for comparing regions."""
+        return self.box, None if self.mask is None else self.mask.tobytes()
+
+    def describe(self):
+        """Returns a short description of the region, such as '200×100 at (10, 20)'."""
+        left, upper, right, lower = self.box
+        return f'{right - left}×{lower - upper} at ({left}, {upper})'
+
+    def clip(self, size):
+        """Returns the box of the region inside an image of a given size, or None."""
+        left, upper, right, lower = self.box
+        box = (max(left, 0), max(upper, 0), min(right, size[0]), min(lower, size[1]))
+        return box if box[2] > box[0] and box[3] > box[1] else None
+
+    def scaled(self, size, new_size):
+        """Returns the region covering the same part of an image resized from size to new_size."""
+        scale_x = new_size[0] / size[0]
+        scale_y = new_size[1] / size[1]
+        left, upper, right, lower = self.box
+
+        # Scaled regions cover at least one pixel
+        box = (floor(left * scale_x), floor(upper * scale_y),
+            max(ceil(right * scale_x), floor(left * scale_x) + 1),
+            max(ceil(lower * scale_y), floor(upper * scale_y) + 1))
+        mask = None if self.mask is None else \
+            self.mask.resize((box[2] - box[0], box[3] - box[1]))
+        return Region(box, mask)
+
+    def tile_boxes(self, size, tile_side=REGION_TILE):
+        """Returns the boxes of the grid tiles the region touches, in row-major order."""
+        box = self.clip(size)
+        if box is None:
+            return []
+
+        left, upper, right, lower = box
+        return [(tile_left, tile_upper, min(tile_left + tile_side, size[0]),
+                min(tile_upper + tile_side, size[1]))
+            for tile_upper in range(upper // tile_side * tile_side, lower, tile_side)
+            for tile_left in range(left // tile_side * tile_side, right, tile_side)]
+
+    def apply(self, current_image, pipeline, apply_pipeline=None):
+        """Applies a pipeline to the region of an image, returns the new image and its change.
+
+        Only the tiles the region touches are filtered, with the pixels around them
+        that the filters read. Pipelines are run by apply_pipeline(image, pipeline)
+        if given, which returns None to cancel, and then (None, None) is returned.
+        The change is None if the image had to be expanded to a mode holding the
+        result, such as color results in a grayscale image.
+        """
+        tile_boxes = self.tile_boxes(current_image.size)
+        if not tile_boxes:
+            return current_image, RegionChange([], [], [])
+
+        # Tiles are filtered as one crop, widened by how far the filters read
+        bounds = (tile_boxes[0][0], tile_boxes[0][1], tile_boxes[-1][2], tile_boxes[-1][3])
+        radius = pipeline.radius()
+        crop_box = (max(bounds[0] - radius, 0), max(bounds[1] - radius, 0),
+            min(bounds[2] + radius, current_image.width),
+            min(bounds[3] + radius, current_image.height))
+
+        crop = current_image.crop(crop_box)
+        filtered = pipeline.apply(crop) if apply_pipeline is None else \
+            apply_pipeline(crop, pipeline)
+        if filtered is None:
+            return None, None
+
+        # Results in another mode expand the image, P crops get a palette of their own
+        base_image = current_image
+        if filtered.mode != base_image.mode or base_image.mode == 'P':
+            base_image = to_filter_mode(base_image)
+        if filtered.mode != base_image.mode:
+            filtered = filtered.convert(base_image.mode)
+
+        # Pixels of the tiles outside the region are left unchanged
+        mask = Image.new('L', (bounds[2] - bounds[0], bounds[3] - bounds[1]))
+        region_box = self.clip(current_image.size)
+        region_mask = 255 if self.mask is None else self.mask.crop((
+            region_box[0] - self.box[0], region_box[1] - self.box[1],
+            region_box[2] - self.box[0], region_box[3] - self.box[1]))
+        mask.paste(region_mask, (region_box[0] - bounds[0], region_box[1] - bounds[1],
+            region_box[2] - bounds[0], region_box[3] - bounds[1]))
+
+        new_image = base_image.copy()
+        new_image.paste(filtered.crop((bounds[0] - crop_box[0], bounds[1] - crop_box[1],
+            bounds[2] - crop_box[0], bounds[3] - crop_box[1])), bounds[:2], mask)
+
+        if base_image is not current_image:
+            return new_image, None
+        return new_image, RegionChange(tile_boxes,
+            [current_image.crop(box) for box in tile_boxes],
+            [new_image.crop(box) for box in tile_boxes])
+
+class RegionChange:
+    """This class contains the tiles a region step changed, as they were before and after it."""
+    def __init__(self, boxes, before, after):
+        self.boxes = boxes
+        self.before = before
+        self.after = after
+
+    def apply(self, current_image):
+        """Returns a copy of the image before the step with the step applied."""
+        return self.paste(current_image, self.after)
+
+    def revert(self, current_image):
+        """Returns a copy of the image after the step with the step undone."""
+        return self.paste(current_image, self.before)
+
+    def paste(self, current_image, tiles):
+        """Returns a copy of an image with tiles pasted at the boxes of the change."""
+        new_image = current_image.copy()
+        for box, tile in zip(self.boxes, tiles):
+            new_image.paste(tile, box[:2])
+        return new_image
+
+class RegionPipeline:
+    """This class contains pipelines applied in order, each to the whole image or to a region.
+
+    Segments are (step count, pipeline, region, change) tuples, where the step
+    count is the number of steps once the segment is applied. Region segments
+    with a known change are replayed by pasting its tiles instead of filtering.
+    """
+    def __init__(self, segments=()):
+        self.segments = list(segments)
+        self.changes = {}
+
+    @property
+    def steps(self):
+        """Returns the (filter, intensity) steps of all segments."""
+        return [step for _, pipeline, _, _ in self.segments for step in pipeline.steps]
+
+    def radius(self):
+        """Returns how far the filters of the segments read around each pixel."""
+        return max((pipeline.radius() for _, pipeline, _, _ in self.segments), default=0)
+
+    def apply(self, current_image, apply_pipeline=None):
+        """Applies every segment to an image, see Region.apply for apply_pipeline.
+
+        Returns None if apply_pipeline cancels. Changes of region segments that
+        are filtered are kept in changes by their step count.
+        """
+        self.changes = {}
+
+        for index, pipeline, region, change in self.segments:
+            if region is None:
+                current_image = pipeline.apply(current_image) if apply_pipeline is None else \
+                    apply_pipeline(current_image, pipeline)
+            elif change is not None:
+                current_image = change.apply(current_image)
+            else:
+                current_image, self.changes[index] = region.apply(current_image, pipeline,
+                    apply_pipeline)
+
+            if current_image is None:
+                return None
+
+        return current_image
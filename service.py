@@ -0,0 +1,439 @@
+"""Local HTTP service for applying filters to images sent by other programs.
+
+Example:
+    python service.py --port 8080
+    curl --data-binary @photo.png -o filtered.png \
+        'http://127.0.0.1:8080/filter?filters=sepia,lighter:3'
+
+POST /filter takes an encoded image as body and a recipe as filters parameter, and
+answers with the filtered image, encoded in the format given as format parameter or
+in the format of the sent image. GET /stats answers with latency percentiles, queue
+depth and request counts as JSON.
+"""
+import argparse
+import asyncio
+import io
+import json
+import signal
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from multiprocessing import cpu_count
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+from filters import COMPACT_MODES, to_filter_mode
+from image import parse_save_options
+from pipeline import FilterPipeline
+
+# Default address the service listens on, only this machine can reach it
+HOST = '127.0.0.1'
+PORT = 8080
+
+# Default number of megabytes the requests being filtered at once may use
+MEMORY_BUDGET = 1024
+
+# Default number of requests that may wait for memory before new ones are refused
+QUEUE_LIMIT = 64
+
+# Default seconds a request waits for memory before it is refused
+QUEUE_TIMEOUT = 10
+
+# Requests with bodies up to this many bytes are sent to the pool in batches
+SMALL_REQUEST = 256 * 1024
+
+# Default number of requests in a batch and milliseconds a batch waits for more requests
+BATCH_SIZE = 16
+BATCH_DELAY = 5
+
+# Largest request body in bytes
+MAX_BODY = 256 * 1024 ** 2
+
+# Number of latest latencies the percentiles are computed from
+LATENCY_COUNT = 10000
+
+class ServiceError(Exception):
+    """This class contains an HTTP status a request is answered with instead of an image."""
+    def __init__(self, status, message=''):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+
+def percentile(values, percent):
+    """Returns a percentile of sorted values, or None if there are none."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+async def read_message(reader, max_body=MAX_BODY):
+    """Reads an HTTP message from a stream, returns its start line, headers and body.
+
+    Returns None if the stream ends before a message starts. Header names are
+    lower case.
+    """
+    start_line = await reader.readline()
+    if not start_line:
+        return None
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    # Bodies must have a length, so they can be refused before they are read
+    if 'transfer-encoding' in headers:
+        raise ServiceError(HTTPStatus.LENGTH_REQUIRED)
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError as exc:
+        raise ServiceError(HTTPStatus.BAD_REQUEST, 'Invalid Content-Length') from exc
+    if length > max_body:
+        raise ServiceError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+    body = await reader.readexactly(length)
+    return start_line.decode('latin-1').strip(), headers, body
+
+def write_message(writer, start_line, headers, body=b''):
+    """Writes an HTTP message with a start line, headers and a body to a stream."""
+    lines = [start_line] + [f'{name}: {value}' for name, value in headers.items()]
+    lines += [f'Content-Length: {len(body)}', '', '']
+    writer.write('\r\n'.join(lines).encode('latin-1') + body)
+
+def estimate_memory(data):
+    """Estimates the number of bytes needed to filter an encoded image, without decoding it."""
+    try:
+        with Image.open(io.BytesIO(data)) as current_image:
+            decoded_bytes = current_image.width * current_image.height * \
+                len(current_image.getbands())
+    except Image.DecompressionBombError as exc:
+        raise ServiceError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, str(exc)) from exc
+    except (OSError, ValueError) as exc:
+        raise ServiceError(HTTPStatus.BAD_REQUEST, 'Body is not an image') from exc
+
+    # Body and encoded result, decoded image and its filtered copy are alive at once
+    return len(data) * 2 + max(decoded_bytes, 1) * 2
+
+def filter_request(data, pipeline, image_format, save_options):
+    """Decodes an image, applies a pipeline and encodes the result, run in a worker.
+
+    Returns the encoded image and its format, which is the format of the sent
+    image if none is given.
+    """
+    with Image.open(io.BytesIO(data)) as current_image:
+        image_format = image_format or current_image.format
+        current_image.load()
+
+        # Filters work on RGB and RGBA images, single channel and P images are kept
+        if current_image.mode in COMPACT_MODES or current_image.mode == 'P':
+            new_image = pipeline.apply(current_image)
+        else:
+            new_image = pipeline.apply(to_filter_mode(current_image))
+
+    output = io.BytesIO()
+    new_image.save(output, image_format, **save_options.get(image_format, {}))
+    return output.getvalue(), image_format
+
+def filter_requests(requests):
+    """Runs filter_request for a batch of requests, run in a worker.
+
+    Returns the status of each request and its result or error message.
+    """
+    results = []
+
+    # A request that fails does not fail the rest of its batch
+    for request in requests:
+        try:
+            results.append((HTTPStatus.OK, filter_request(*request)))
+        except Image.DecompressionBombError as exc:
+            results.append((HTTPStatus.REQUEST_ENTITY_TOO_LARGE, str(exc)))
+        except (OSError, ValueError, KeyError) as exc:
+            results.append((HTTPStatus.BAD_REQUEST, f'Could not filter image: {exc}'))
+
+    return results
+
+class FilterService:
+    """This class contains the state of the service: the shared process pool, the memory
+    of the requests in flight, the batch of small requests and the latest latencies.
+
+    Requests wait for their memory to fit in the budget. They are refused with 429
+    when too many requests already wait, and with 503 when waiting takes too long.
+    """
+    def __init__(self, pool, memory_budget=MEMORY_BUDGET * 1024 ** 2, queue_limit=QUEUE_LIMIT,
+            queue_timeout=QUEUE_TIMEOUT, batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY,
+            save_options=None):
+        self.pool = pool
+        self.memory_budget = memory_budget
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.save_options = save_options or {}
+
+        # Memory of the requests in flight, requests waiting for it are woken once freed
+        self.memory_used = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.memory_freed = asyncio.Condition()
+
+        # Small requests gathered for the next batch, sent once full or once the delay passed
+        self.batch = []
+        self.batch_timer = None
+
+        self.latencies = deque(maxlen=LATENCY_COUNT)
+        self.statuses = Counter()
+        self.batch_count = 0
+        self.batched_count = 0
+
+    async def serve(self, host=HOST, port=PORT):
+        """Answers requests on a host and port until the process is terminated."""
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f'Serving on http://{host}:{port}', flush=True)
+
+        # Terminating the service stops it like an interrupt, so the pool is shut down
+        stopped = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+        except NotImplementedError:
+            pass
+
+        try:
+            await stopped.wait()
+        finally:
+            server.close()
+
+    async def handle_connection(self, reader, writer):
+        """Answers the requests of a connection, which is kept open between requests."""
+        try:
+            while True:
+                try:
+                    message = await read_message(reader)
+                except ServiceError as exc:
+                    # Bodies of refused messages are not read, so the connection is closed
+                    self.statuses[exc.status] += 1
+                    write_message(writer, f'HTTP/1.1 {exc.status} {exc.status.phrase}',
+                        {'Content-Type': 'text/plain', 'Connection': 'close'},
+                        str(exc).encode())
+                    await writer.drain()
+                    break
+                if message is None:
+                    break
+
+                start_line, headers, body = message
+                start_time = time.perf_counter()
+                status, response_headers, content = await self.respond(start_line, body)
+                self.statuses[status] += 1
+
+                write_message(writer, f'HTTP/1.1 {status} {HTTPStatus(status).phrase}',
+                    response_headers, content)
+                await writer.drain()
+
+                if start_line.split(' ')[1:2] != ['/stats']:
+                    self.latencies.append(time.perf_counter() - start_time)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, start_line, body):
+        """Returns the status, headers and content a request is answered with."""
+        try:
+            method, target, _ = start_line.split(' ', 2)
+        except ValueError:
+            method, target = None, ''
+        url = urlsplit(target)
+
+        try:
+            if url.path == '/stats':
+                if method != 'GET':
+                    raise ServiceError(HTTPStatus.METHOD_NOT_ALLOWED)
+                return HTTPStatus.OK, {'Content-Type': 'application/json'}, \
+                    json.dumps(self.stats()).encode()
+
+            if url.path != '/filter':
+                raise ServiceError(HTTPStatus.NOT_FOUND)
+            if method != 'POST':
+                raise ServiceError(HTTPStatus.METHOD_NOT_ALLOWED)
+
+            # Recipes and formats are checked before any work is done
+            query = parse_qs(url.query)
+            if 'filters' not in query:
+                raise ServiceError(HTTPStatus.BAD_REQUEST, 'Missing filters parameter')
+            try:
+                pipeline = FilterPipeline.parse(query['filters'][0])
+            except ValueError as exc:
+                raise ServiceError(HTTPStatus.BAD_REQUEST, str(exc)) from exc
+
+            image_format = None
+            if 'format' in query:
+                image_format = Image.registered_extensions().get(
+                    '.' + query['format'][0].lower())
+                if image_format is None:
+                    raise ServiceError(HTTPStatus.BAD_REQUEST,
+                        f'Unknown format: {query["format"][0]}')
+
+            content, image_format = await self.filter(body, pipeline, image_format)
+            return HTTPStatus.OK, \
+                {'Content-Type': Image.MIME.get(image_format, 'application/octet-stream')}, \
+                content
+
+        except ServiceError as exc:
+            # Refused requests can be retried once the service has caught up
+            headers = {'Content-Type': 'text/plain'}
+            if exc.status in (HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.SERVICE_UNAVAILABLE):
+                headers['Retry-After'] = '1'
+            return exc.status, headers, str(exc).encode()
+
+    async def filter(self, data, pipeline, image_format):
+        """Filters an encoded image on the pool once its memory fits in the budget."""
+        memory = estimate_memory(data)
+        if memory > self.memory_budget:
+            raise ServiceError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                'Image needs more memory than the service may use')
+
+        await self.reserve(memory)
+        try:
+            request = (data, pipeline, image_format, self.save_options)
+            if len(data) <= SMALL_REQUEST:
+                status, result = await self.submit_batched(request)
+            else:
+                results = await asyncio.wrap_future(self.pool.submit(filter_requests, [request]))
+                status, result = results[0]
+        finally:
+            await self.release(memory)
+
+        if status != HTTPStatus.OK:
+            raise ServiceError(status, result)
+        return result
+
+    async def reserve(self, memory):
+        """Waits until a number of bytes fits in the memory budget and reserves them."""
+        async with self.memory_freed:
+            def fits():
+                return self.memory_used + memory <= self.memory_budget
+
+            if not fits():
+                if self.waiting >= self.queue_limit:
+                    raise ServiceError(HTTPStatus.TOO_MANY_REQUESTS)
+
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(self.memory_freed.wait_for(fits), self.queue_timeout)
+                except asyncio.TimeoutError as exc:
+                    raise ServiceError(HTTPStatus.SERVICE_UNAVAILABLE) from exc
+                finally:
+                    self.waiting -= 1
+
+            self.memory_used += memory
+            self.in_flight += 1
+
+    async def release(self, memory):
+        """Frees reserved bytes and wakes the requests waiting for memory."""
+        async with self.memory_freed:
+            self.memory_used -= memory
+            self.in_flight -= 1
+            self.memory_freed.notify_all()
+
+    def submit_batched(self, request):
+        """Adds a small request to the next batch, returns a future of its result."""
+        future = asyncio.get_running_loop().create_future()
+        self.batch.append((request, future))
+
+        if len(self.batch) >= self.batch_size:
+            self.send_batch()
+        elif self.batch_timer is None:
+            self.batch_timer = asyncio.get_running_loop().call_later(self.batch_delay / 1000,
+                self.send_batch)
+
+        return future
+
+    def send_batch(self):
+        """Sends the gathered small requests to the pool as one task."""
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+
+        batch, self.batch = self.batch, []
+        self.batch_count += 1
+        self.batched_count += len(batch)
+
+        task = asyncio.wrap_future(self.pool.submit(filter_requests,
+            [request for request, _ in batch]))
+        task.add_done_callback(lambda task: self.finish_batch(task,
+            [future for _, future in batch]))
+
+    def finish_batch(self, task, futures):
+        """Hands the results of a finished batch to the requests waiting for them."""
+        if task.exception() is not None:
+            results = [(HTTPStatus.BAD_REQUEST, f'Could not filter image: {task.exception()}')] * \
+                len(futures)
+        else:
+            results = task.result()
+
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        """Returns latency percentiles in milliseconds, queue depth and request counts."""
+        latencies = sorted(latency * 1000 for latency in self.latencies)
+        return {
+            'queue_depth': self.waiting + len(self.batch),
+            'waiting_for_memory': self.waiting,
+            'waiting_for_batch': len(self.batch),
+            'in_flight': self.in_flight,
+            'memory_used_mb': self.memory_used / 1024 ** 2,
+            'memory_budget_mb': self.memory_budget / 1024 ** 2,
+            'latency_ms': {f'p{percent}': percentile(latencies, percent)
+                for percent in (50, 90, 99)},
+            'responses': {str(int(status)): count for status, count in self.statuses.items()},
+            'batches': self.batch_count,
+            'batched_requests': self.batched_count
+        }
+
+def main(arguments=None):
+    """Parses command line arguments and runs the service until interrupted."""
+    parser = argparse.ArgumentParser(description='Serve the filters over HTTP on this machine.')
+    parser.add_argument('--host', default=HOST, help=f'address to listen on (default: {HOST})')
+    parser.add_argument('-p', '--port', type=int, default=PORT,
+        help=f'port to listen on (default: {PORT})')
+    parser.add_argument('-w', '--workers', type=int, default=cpu_count(),
+        help='number of worker processes (default: CPU count)')
+    parser.add_argument('-m', '--memory', type=int, default=MEMORY_BUDGET,
+        help=f'megabytes of requests in flight at once (default: {MEMORY_BUDGET})')
+    parser.add_argument('--queue', type=int, default=QUEUE_LIMIT,
+        help='requests waiting for memory before new ones get 429 '
+        f'(default: {QUEUE_LIMIT})')
+    parser.add_argument('--queue-timeout', type=float, default=QUEUE_TIMEOUT,
+        help=f'seconds a request waits for memory before it gets 503 (default: {QUEUE_TIMEOUT})')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+        help=f'small requests sent to a worker at once (default: {BATCH_SIZE})')
+    parser.add_argument('--batch-delay', type=float, default=BATCH_DELAY,
+        help=f'milliseconds a batch waits for more requests (default: {BATCH_DELAY})')
+    parser.add_argument('--save-options', default='',
+        help="comma separated encoder options by format, e.g. 'png.compress_level=1'")
+    arguments = parser.parse_args(arguments)
+
+    try:
+        save_options = parse_save_options(arguments.save_options)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    with ProcessPoolExecutor(arguments.workers) as pool:
+        service = FilterService(pool, arguments.memory * 1024 ** 2, arguments.queue,
+            arguments.queue_timeout, arguments.batch_size, arguments.batch_delay, save_options)
+        try:
+            asyncio.run(service.serve(arguments.host, arguments.port))
+        except KeyboardInterrupt:
+            pass
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""This module contains functions for filtering images band by band without loading them.
+
+Every filter works on single pixels, so an image can be decoded, filtered and
+encoded one band of rows at a time. Peak memory then depends on the band height
+and not on the image size.
+
+Inputs must store their pixels uncompressed in full width strips, as PPM, BMP,
+TGA and uncompressed TIFF files do. Outputs are written as PNG.
+"""
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+from filters import to_filter_mode
+from image import atomic_file
+from pipeline import gray_ramp
+
+# Default number of rows decoded, filtered and encoded at once
+BAND_HEIGHT = 64
+
+# Bytes per pixel of the raw layouts that can be read band by band
+RAW_PIXEL_SIZES = {'L': 1, 'RGB': 3, 'BGR': 3, 'RGBA': 4, 'RGBX': 4, 'BGRA': 4, 'BGRX': 4}
+
+# PNG color type of each output mode
+PNG_COLOR_TYPES = {'L': 0, 'LA': 4, 'RGB': 2, 'RGBA': 6}
+
+class PNGWriter:
+    """This class writes a PNG file band by band."""
+    def __init__(self, file, size, mode, compress_level=6):
+        self.file = file
+        self.compressor = zlib.compressobj(compress_level)
+
+        # Rows are stored as differences to the row above, which starts as zeros
+        row_size = size[0] * Image.getmodebands(mode)
+        self.previous_row = np.zeros(row_size, dtype=np.uint8)
+
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', size[0], size[1], 8,
+            PNG_COLOR_TYPES[mode], 0, 0, 0))
+
+    def write_chunk(self, chunk_type, data):
+        """Writes a PNG chunk."""
+        self.file.write(struct.pack('>I', len(data)) + chunk_type + data +
+            struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+    def write(self, band):
+        """Encodes a band of rows and writes the compressed data."""
+        rows = np.asarray(band).reshape(band.height, -1)
+
+        # Use the PNG 'Up' filter on every row, the filter type byte precedes each row
+        filtered_rows = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered_rows[:, 0] = 2
+        filtered_rows[0, 1:] = rows[0] - self.previous_row
+        filtered_rows[1:, 1:] = rows[1:] - rows[:-1]
+        self.previous_row = rows[-1].copy()
+
+        data = self.compressor.compress(filtered_rows.tobytes())
+        if data:
+            self.write_chunk(b'IDAT', data)
+
+    def close(self):
+        """Writes the remaining compressed data and ends the file."""
+        self.write_chunk(b'IDAT', self.compressor.flush())
+        self.write_chunk(b'IEND', b'')
+
+def open_source(image_path):
+    """Opens an image without decoding it or limiting its number of pixels."""
+    # Memory does not grow with the image size when streaming, so allow any size
+    max_image_pixels = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        return Image.open(image_path)
+    finally:
+        Image.MAX_IMAGE_PIXELS = max_image_pixels
+
+def check_source(source):
+    """Raises an error if an opened image can't be read band by band."""
+    if source.mode not in ('L', 'RGB', 'RGBA'):
+        raise ValueError(f'Streaming does not support {source.mode} images')
+
+    for codec, (left, _, right, _), _, args in source.tile:
+        if codec != 'raw' or left != 0 or right != source.width:
+            raise ValueError('Streaming needs an uncompressed image stored in full width strips')
+
+        rawmode = args[0] if isinstance(args, tuple) else args
+        if rawmode not in RAW_PIXEL_SIZES:
+            raise ValueError(f'Streaming does not support the {rawmode} pixel layout')
+
+def read_rows(source, stream, first_row, last_row):
+    """Decodes a range of rows of an image file passed by check_source into a new image."""
+    parts = []
+
+    for _, (_, upper, _, lower), offset, args in source.tile:
+        # Skip strips outside the range
+        top = max(upper, first_row)
+        bottom = min(lower, last_row)
+        if top >= bottom:
+            continue
+
+        rawmode, stride, orientation = args if isinstance(args, tuple) else (args, 0, 1)
+        stride = stride or RAW_PIXEL_SIZES[rawmode] * source.width
+
+        # Bottom-up strips store their last row first
+        first_stored_row = lower - bottom if orientation < 0 else top - upper
+        stream.seek(offset + first_stored_row * stride)
+        data = stream.read((bottom - top) * stride)
+
+        parts.append((top, Image.frombytes(source.mode, (source.width, bottom - top), data,
+            'raw', rawmode, stride, orientation)))
+
+    # Range is usually inside a single strip and needs no pasting
+    if len(parts) == 1:
+        return parts[0][1]
+
+    band = Image.new(source.mode, (source.width, last_row - first_row))
+    for top, part in parts:
+        band.paste(part, (0, top - first_row))
+    return band
+
+def stream_filter(image_path, output_path, pipeline, band_height=BAND_HEIGHT):
+    """Applies a pipeline to an image file band by band and saves it as PNG.
+
+    The output is only created once the image is known to stream and replaces
+    the file at the output path when it is complete, see atomic_file. Returns
+    the megapixels of the image.
+    """
+    with open_source(image_path) as source, open(image_path, 'rb') as stream:
+        check_source(source)
+        with atomic_file(output_path) as output:
+            stream_bands(source, stream, output, pipeline, band_height)
+
+    return source.width * source.height / 1_000_000
+
+def output_mode(source, pipeline):
+    """Returns the mode all filtered bands of an image passed by check_source are written in.
+
+    Bands whose pixels all happen to be gray are compacted by the pipeline, so the
+    mode is decided by the filters and not by the pixels of any one band.
+    """
+    stages = pipeline.compile()
+    mode = 'RGBA' if source.mode == 'RGBA' else 'RGB'
+    if stages and stages[-1].gray_output():
+        return {'RGB': 'L', 'RGBA': 'LA'}[mode]
+
+    # Grayscale images stay grayscale if the filters keep every gray value gray
+    if source.mode == 'L':
+        ramp = Image.fromarray(gray_ramp()[..., 0])
+        if pipeline.apply(ramp).mode in ('L', '1'):
+            return 'L'
+
+    return mode
+
+def stream_bands(source, stream, output, pipeline, band_height):
+    """Filters the bands of an image file passed by check_source and writes them as PNG."""
+    mode = output_mode(source, pipeline)
+    writer = PNGWriter(output, source.size, mode)
+    for first_row in range(0, source.height, band_height):
+        band = read_rows(source, stream, first_row, min(first_row + band_height, source.height))
+        band = pipeline.apply(to_filter_mode(band))
+
+        # Compacted bands, and black and white ones written as 8 bit grayscale, are
+        # converted back to the mode of the output
+        if band.mode != mode:
+            band = band.convert(mode)
+        writer.write(band)
+
+    writer.close()
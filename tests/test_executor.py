@@ -0,0 +1,70 @@
+"""Tests for the worker pool filtering images in shared memory."""
+import time
+import uuid
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from executor import FilterExecutor
+
+class FailingStage:
+    """This class contains a pass that fails on tiles holding black pixels and slowly
+    leaves a file behind for every other tile."""
+    radius = 0
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __call__(self, channels, intensity):
+        """Runs the pass over the pixels of a tile."""
+        if not channels.all():
+            raise ValueError('Black pixel')
+
+        time.sleep(0.2)
+        (self.directory / uuid.uuid4().hex).touch()
+        return channels
+
+    def gray_output(self):
+        """Passes leave color images in color."""
+        return False
+
+class FailingPipeline:
+    """This class contains a pipeline of a single FailingStage."""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def compile(self):
+        """Returns the passes of the pipeline."""
+        return [FailingStage(self.directory)]
+
+@pytest.fixture(scope='module')
+def executor():
+    """Yields a worker pool of two processes."""
+    with FilterExecutor(2, tile_size=3 * 64 * 64) as executor:
+        yield executor
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_failed_tile_waits_for_others(executor, tmp_path, workers):
+    """A failed tile raises only once no other tile is still writing into the shared buffers."""
+    pixels = np.full((256, 256, 3), (255, 128, 64), dtype=np.uint8)
+    pixels[0, 0] = 0
+
+    with pytest.raises(ValueError, match='Black pixel'):
+        executor.apply_pipeline(Image.fromarray(pixels), FailingPipeline(tmp_path),
+            workers=workers)
+    finished_tiles = len(list(tmp_path.iterdir()))
+
+    time.sleep(0.5)
+    assert len(list(tmp_path.iterdir())) == finished_tiles
+
+def test_apply_after_failed_tile(executor, tmp_path):
+    """Applies after a failed tile run every tile again."""
+    pixels = np.full((256, 256, 3), (255, 128, 64), dtype=np.uint8)
+    pixels[0, 0] = 0
+    with pytest.raises(ValueError):
+        executor.apply_pipeline(Image.fromarray(pixels), FailingPipeline(tmp_path))
+
+    pixels[0, 0] = 1
+    new_image = executor.apply_pipeline(Image.fromarray(pixels), FailingPipeline(tmp_path))
+    assert np.array_equal(np.asarray(new_image), pixels)
@@ -0,0 +1,62 @@
+"""Tests for the filters and the engines they run on."""
+import numpy as np
+import pytest
+from PIL import Image
+
+from benchmark import generate_image
+from filters import ENGINES, FILTER_TRAITS, FILTERS, set_engine
+from pipeline import FilterPipeline
+
+@pytest.fixture
+def palette_path(tmp_path):
+    """Writes an indexed PNG with a transparent index and returns its path."""
+    path = tmp_path / 'palette.png'
+    generate_image(0.01, 'RGB', 1).convert('P').save(path, transparency=0)
+    return path
+
+@pytest.mark.parametrize('name', FILTERS)
+def test_palette_file(palette_path, name):
+    """P images opened from a file are filtered through their palette."""
+    with Image.open(palette_path) as current_image:
+        new_image = FILTERS[name](current_image, 1)
+    with Image.open(palette_path) as current_image:
+        expected = FILTERS[name](current_image.convert('RGBA'), 1)
+
+    assert new_image.mode == 'P'
+    assert np.array_equal(np.asarray(new_image.convert('RGBA')), np.asarray(expected))
+
+def test_palette_file_pipeline(palette_path):
+    """Pipelines filter P images opened from a file through their palette."""
+    with Image.open(palette_path) as current_image:
+        new_image = FilterPipeline.parse('sepia,lighter:3').apply(current_image)
+
+    assert new_image.mode == 'P'
+
+@pytest.fixture
+def engine():
+    """Yields a function selecting an engine, the default engine is selected again after."""
+    yield set_engine
+    set_engine('lut')
+
+@pytest.mark.parametrize('name', FILTERS)
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA'])
+@pytest.mark.parametrize('intensity', [1, 3, 10])
+def test_engines_identical(engine, name, mode, intensity):
+    """Every engine gives the same bytes as the per-pixel reference loops."""
+    current_image = generate_image(0.0004, mode, 6)
+    if not FILTER_TRAITS[FILTERS[name]].uses_intensity and intensity != 1:
+        pytest.skip('filter does not use the intensity')
+
+    results = {}
+    for engine_name in ENGINES:
+        engine(engine_name)
+        new_image = FILTERS[name](current_image, intensity)
+        results[engine_name] = (new_image.mode, new_image.tobytes())
+
+    assert results['lut'] == results['python']
+    assert results['numpy'] == results['python']
+
+def test_unknown_engine(engine):
+    """Unknown engines are refused."""
+    with pytest.raises(ValueError):
+        engine('gpu')
@@ -0,0 +1,60 @@
+"""Tests for filtering every frame of animations."""
+import numpy as np
+import pytest
+from PIL import Image, ImageSequence
+
+import batch
+from benchmark import generate_image
+from frames import filter_frames
+from pipeline import FilterPipeline
+
+@pytest.fixture
+def gif_path(tmp_path):
+    """Writes an animated GIF with a transparent index and returns its path."""
+    path = tmp_path / 'animation.gif'
+    frames = [generate_image(0.01, 'RGB', seed).quantize(64) for seed in range(4)]
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=80, loop=0,
+        transparency=0)
+    return path
+
+@pytest.mark.parametrize('extension', ['png', 'webp', 'gif', 'tiff'])
+def test_gif_frames(tmp_path, gif_path, extension):
+    """GIF frames, decoded in more than one mode, are saved in every animated format."""
+    output_path = tmp_path / f'output.{extension}'
+    filter_frames(gif_path, output_path, FilterPipeline.parse('sepia'))
+
+    with Image.open(output_path) as new_image:
+        assert new_image.n_frames == 4
+
+def test_gif_frames_png_pixels(tmp_path, gif_path):
+    """Frames converted to one mode keep the pixels of each filtered frame."""
+    output_path = tmp_path / 'output.png'
+    pipeline = FilterPipeline.parse('sepia')
+    filter_frames(gif_path, output_path, pipeline)
+
+    with Image.open(gif_path) as source, Image.open(output_path) as new_image:
+        for frame, new_frame in zip(ImageSequence.Iterator(source),
+                ImageSequence.Iterator(new_image)):
+            expected = pipeline.apply(frame.copy()).convert('RGBA')
+            assert np.array_equal(np.asarray(new_frame.convert('RGBA')), np.asarray(expected))
+
+def test_batch_stream_gif(tmp_path, gif_path):
+    """Animations in a streamed batch run are saved as animated PNG files."""
+    output = tmp_path / 'out'
+    assert batch.main([str(gif_path), '-f', 'sepia', '-o', str(output), '--stream',
+        '-w', '1']) == 0
+
+    with Image.open(output / 'animation.png') as new_image:
+        assert new_image.n_frames == 4
+
+def test_batch_frame_failure(tmp_path, gif_path, monkeypatch):
+    """A failed animation is reported and the other images are still filtered."""
+    def fail(*arguments):
+        raise RuntimeError('encoder failed')
+    monkeypatch.setattr(batch, 'filter_frames', fail)
+    generate_image(0.01, 'RGB', 5).save(tmp_path / 'still.png')
+
+    output = tmp_path / 'out'
+    assert batch.main([str(gif_path), str(tmp_path / 'still.png'), '-f', 'sepia',
+        '-o', str(output), '-w', '1']) == 1
+    assert (output / 'still.png').exists()
@@ -0,0 +1,28 @@
+"""Tests for the undo history replaying evicted images."""
+import numpy as np
+import pytest
+
+from benchmark import generate_image
+from history import ImageHistory
+from pipeline import FilterPipeline
+
+# Recipes whose steps expand gray images to color and make them gray again
+RECIPES = ['black_and_white,cold,lighter:4', 'black_and_white,sepia,colorful',
+    'grayscale,warm,grayscale', 'colorful,cold,lighter:4', 'invert,sepia,darker:5',
+    'sepia,lighter:3,cold']
+
+@pytest.mark.parametrize('recipe', RECIPES)
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'L', 'LA'])
+def test_replay_matches_steps(recipe, mode):
+    """Images replayed after their snapshots were evicted match the images built step by step."""
+    current_image = generate_image(0.002, 'RGBA', 7).convert(mode)
+    history = ImageHistory(current_image, budget=0)
+    for step in FilterPipeline.parse(recipe).steps:
+        current_image = FilterPipeline([step]).apply(current_image)
+        history.append(*step, current_image)
+
+    history.snapshots.clear()
+    new_image = history.current
+
+    assert new_image.mode == current_image.mode
+    assert np.array_equal(np.asarray(new_image), np.asarray(current_image))
@@ -0,0 +1,56 @@
+"""Tests for pipelines fusing stacked filters into fewer passes."""
+from itertools import product
+
+import numpy as np
+import pytest
+
+from benchmark import generate_image
+from filters import FILTER_TRAITS, FILTERS
+from pipeline import FilterPipeline
+
+# Every filter with each intensity it takes
+STEPS = [(name, intensity) for name, image_filter in FILTERS.items()
+    for intensity in ((1, 4) if FILTER_TRAITS[image_filter].uses_intensity else (1,))]
+
+# Recipes of every pair of steps, and some longer ones
+RECIPES = [','.join(f'{name}:{intensity}' for name, intensity in steps)
+    for steps in product(STEPS, repeat=2)] + [
+    'sepia,lighter:3,cold', 'grayscale,warm,darker:2', 'invert,colorful,invert,sepia',
+    'black_and_white,lighter:5,grayscale', 'cold,warm,cold,warm,lighter:2']
+
+def apply_steps(current_image, recipe):
+    """Applies the filters of a recipe one at a time."""
+    for image_filter, intensity in FilterPipeline.parse(recipe).steps:
+        current_image = image_filter(current_image, intensity)
+    return current_image
+
+@pytest.mark.parametrize('recipe', RECIPES)
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA'])
+def test_fused_matches_steps(recipe, mode):
+    """Fused passes give the same pixels as applying every filter on its own."""
+    current_image = generate_image(0.002, mode, 7)
+    expected = apply_steps(current_image, recipe)
+    new_image = FilterPipeline.parse(recipe).apply(current_image)
+
+    # Gray results are kept in a single channel
+    assert np.array_equal(np.asarray(new_image.convert(expected.mode)), np.asarray(expected))
+
+@pytest.mark.parametrize('recipe', RECIPES[::7])
+def test_fused_passes(recipe):
+    """Pipelines never run more passes than they have filters."""
+    pipeline = FilterPipeline.parse(recipe)
+
+    assert 1 <= len(pipeline.compile()) <= len(pipeline.steps)
+
+@pytest.mark.parametrize('recipe', ['sepia,lighter:3', 'grayscale,invert', 'cold:1'])
+def test_recipe_round_trip(recipe):
+    """Recipes of parsed pipelines parse to the same steps."""
+    pipeline = FilterPipeline.parse(recipe)
+
+    assert FilterPipeline.parse(pipeline.recipe()).steps == pipeline.steps
+
+@pytest.mark.parametrize('recipe', ['', 'sepia,unknown', 'sepia:2', 'lighter:x'])
+def test_invalid_recipe(recipe):
+    """Invalid recipes are refused."""
+    with pytest.raises(ValueError):
+        FilterPipeline.parse(recipe)
@@ -0,0 +1,57 @@
+"""Tests for the filtering service."""
+import asyncio
+import io
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+
+import pytest
+from PIL import Image
+
+from benchmark import generate_image
+from service import FilterService
+
+def png_chunk(chunk_type, data):
+    """Returns a PNG chunk."""
+    return struct.pack('>I', len(data)) + chunk_type + data + \
+        struct.pack('>I', zlib.crc32(chunk_type + data))
+
+def png_header(width, height):
+    """Returns a small PNG file claiming a size, without any pixel data."""
+    return b'\x89PNG\r\n\x1a\n' + \
+        png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+        png_chunk(b'IDAT', b'') + png_chunk(b'IEND', b'')
+
+@pytest.fixture(scope='module')
+def pool():
+    """Yields a process pool with one worker."""
+    with ProcessPoolExecutor(1) as pool:
+        yield pool
+
+def respond(pool, target, body):
+    """Returns the status and content the service answers a POST request with."""
+    service = FilterService(pool)
+    status, _, content = asyncio.run(service.respond(f'POST {target} HTTP/1.1', body))
+    return status, content
+
+def test_filter(pool):
+    """Images are answered filtered, in the format they were sent in."""
+    output = io.BytesIO()
+    generate_image(0.01, 'RGB', 8).save(output, 'PNG')
+    status, content = respond(pool, '/filter?filters=sepia', output.getvalue())
+
+    assert status == HTTPStatus.OK
+    assert Image.open(io.BytesIO(content)).format == 'PNG'
+
+def test_decompression_bomb(pool):
+    """Images claiming more pixels than Pillow opens are refused as too large."""
+    status, _ = respond(pool, '/filter?filters=sepia', png_header(20000, 20000))
+
+    assert status == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+
+@pytest.mark.parametrize('target, body', [('/filter?filters=sepia', b'not an image'),
+    ('/filter?filters=unknown', b''), ('/filter', b'')])
+def test_bad_request(pool, target, body):
+    """Bodies that are no image and invalid recipes are refused."""
+    assert respond(pool, target, body)[0] == HTTPStatus.BAD_REQUEST
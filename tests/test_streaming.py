@@ -0,0 +1,71 @@
+"""Tests for filtering images band by band."""
+import numpy as np
+import pytest
+from PIL import Image
+
+from batch import main
+from benchmark import generate_image
+from filters import to_filter_mode
+from pipeline import FilterPipeline
+from streaming import stream_filter
+
+@pytest.mark.parametrize('mode', ['L', 'RGB', 'RGBA'])
+@pytest.mark.parametrize('image_format', ['PPM', 'BMP', 'TIFF'])
+@pytest.mark.parametrize('recipe', ['sepia,lighter:3', 'grayscale', 'black_and_white'])
+def test_stream_matches_in_memory(tmp_path, mode, image_format, recipe):
+    """Streamed results are the same as filtering the whole image in memory."""
+    if image_format == 'PPM' and mode == 'RGBA':
+        pytest.skip('PPM files have no alpha')
+    image_path = tmp_path / f'input.{image_format.lower()}'
+    generate_image(0.02, 'RGBA', 2).convert(mode).save(image_path, image_format)
+    pipeline = FilterPipeline.parse(recipe)
+
+    stream_filter(image_path, tmp_path / 'output.png', pipeline, band_height=7)
+    with Image.open(image_path) as current_image:
+        expected = pipeline.apply(to_filter_mode(current_image))
+
+    # Black and white results are written as 8 bit grayscale
+    if expected.mode == '1':
+        expected = expected.convert('L')
+    with Image.open(tmp_path / 'output.png') as new_image:
+        assert new_image.mode == expected.mode
+        assert np.array_equal(np.asarray(new_image), np.asarray(expected))
+
+@pytest.mark.parametrize('mode', ['L', 'RGB'])
+@pytest.mark.parametrize('gray_rows', [slice(0, 64), slice(100, 200)])
+@pytest.mark.parametrize('recipe', ['lighter:1', 'darker', 'invert', 'sepia'])
+def test_stream_uniform_band(tmp_path, mode, gray_rows, recipe):
+    """Bands left gray, such as white margins of scans, are written in the mode of the others."""
+    pixels = np.asarray(generate_image(0.02, 'RGB', 4).resize((100, 200))).copy()
+    pixels[gray_rows] = 128
+    current_image = Image.fromarray(pixels).convert(mode)
+    image_path = tmp_path / 'input.ppm'
+    current_image.save(image_path)
+    pipeline = FilterPipeline.parse(recipe)
+
+    stream_filter(image_path, tmp_path / 'output.png', pipeline, band_height=64)
+    expected = pipeline.apply(to_filter_mode(current_image))
+    with Image.open(tmp_path / 'output.png') as new_image:
+        assert new_image.mode == (mode if recipe != 'sepia' else 'RGB')
+        assert np.array_equal(np.asarray(to_filter_mode(new_image)),
+            np.asarray(to_filter_mode(expected)))
+
+@pytest.mark.parametrize('image_format', ['PNG', 'JPEG'])
+def test_rejected_input_leaves_no_output(tmp_path, image_format):
+    """Inputs that can't be streamed leave no output behind that counts as up to date."""
+    image_path = tmp_path / f'input.{image_format.lower()}'
+    generate_image(0.01, 'RGB', 3).save(image_path, image_format)
+    output_path = tmp_path / 'output.png'
+
+    with pytest.raises(ValueError):
+        stream_filter(image_path, output_path, FilterPipeline.parse('sepia'))
+    assert list(tmp_path.iterdir()) == [image_path]
+
+def test_batch_rejected_input_fails_again(tmp_path):
+    """Batch runs report inputs that can't be streamed on every run."""
+    generate_image(0.01, 'RGB', 3).save(tmp_path / 'input.png')
+    arguments = [str(tmp_path / 'input.png'), '-f', 'sepia', '-o', str(tmp_path / 'out'),
+        '--stream', '-w', '1']
+
+    assert main(arguments) == 1
+    assert main(arguments) == 1
@@ -0,0 +1,62 @@
+"""Tests for splitting images into tiles and merging them back."""
+import numpy as np
+import pytest
+
+import tiling
+from benchmark import generate_image
+from image import PILImage
+
+# Sizes with odd sides, single rows and columns, and images narrower than the workers
+SIZES = [(1, 1), (1, 37), (37, 1), (3, 5), (7, 13), (101, 67), (640, 3), (2, 1000)]
+
+def coverage(size, boxes):
+    """Returns how many boxes cover each pixel of an image of a given size."""
+    counts = np.zeros((size[1], size[0]), dtype=np.int64)
+    for left, upper, right, lower in boxes:
+        assert 0 <= left < right <= size[0]
+        assert 0 <= upper < lower <= size[1]
+        counts[upper:lower, left:right] += 1
+    return counts
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('workers', [1, 2, 3, 8, 64])
+@pytest.mark.parametrize('square', [False, True])
+def test_split_covers_image_once(size, workers, square):
+    """Tiles cover every pixel of the image exactly once."""
+    boxes = tiling.split(size, 3, workers, 1024, square=square)
+
+    assert (coverage(size, boxes) == 1).all()
+
+@pytest.mark.parametrize('size', SIZES)
+def test_split_row_major(size):
+    """Tiles are in row-major order."""
+    boxes = tiling.split(size, 4, 3, 512, square=True)
+
+    assert boxes == sorted(boxes, key=lambda box: (box[1], box[0]))
+
+def test_split_tile_size():
+    """Row bands hold at most tile_size bytes unless they are a single row."""
+    boxes = tiling.split((300, 200), 3, 1, 9000)
+
+    assert all((right - left) * (lower - upper) * 3 <= 9000
+        for left, upper, right, lower in boxes)
+
+def test_split_workers():
+    """Images get several tiles for each worker as long as they have rows for them."""
+    assert len(tiling.split((50, 100), 3, 4, oversubscription=4)) == 16
+    assert len(tiling.split((50, 5), 3, 4, oversubscription=4)) == 5
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'L'])
+@pytest.mark.parametrize('square', [False, True])
+def test_crop_merge_round_trip(size, mode, square):
+    """Merging the cropped sections gives back the same image."""
+    current_image = generate_image(0.0001, 'RGBA', 4).resize(size).convert(mode)
+    pil_image = PILImage()
+    pil_image.set_image(current_image)
+
+    pil_image.crop(workers=3, tile_size=256, square=square)
+    new_image = pil_image.merge()
+
+    assert new_image.mode == current_image.mode
+    assert new_image.tobytes() == current_image.tobytes()
@@ -0,0 +1,41 @@
+"""This module contains functions for splitting an image into tiles."""
+from math import ceil, isqrt
+
+# Default tile size in bytes, small enough for a tile and the temporary arrays
+# of a filter kernel working on it to stay in the CPU cache
+TILE_SIZE = 256 * 1024
+
+# Default number of tiles per worker, so workers that finish early can pick up
+# more tiles instead of waiting for the slowest one
+OVERSUBSCRIPTION = 4
+
+def band_boxes(width, height, band_count):
+    """Splits an image into horizontal bands of nearly equal height."""
+    # Bands are at least one row high
+    band_count = max(1, min(band_count, height))
+    bounds = [height * index // band_count for index in range(band_count + 1)]
+
+    return [(0, bounds[index], width, bounds[index + 1]) for index in range(band_count)]
+
+def square_boxes(width, height, tile_side):
+    """Splits an image into square tiles, tiles at the right and bottom edges may be smaller."""
+    return [(left, upper, min(left + tile_side, width), min(upper + tile_side, height))
+        for upper in range(0, height, tile_side) for left in range(0, width, tile_side)]
+
+def split(size, bytes_per_pixel, workers=1, tile_size=TILE_SIZE,
+        oversubscription=OVERSUBSCRIPTION, square=False):
+    """Splits an image into tiles of at most tile_size bytes, with several tiles per worker.
+
+    Returns a list of (left, upper, right, lower) boxes in row-major order.
+    """
+    width, height = size
+
+    # Enough tiles to fit in the tile size and to give every worker several tiles
+    tile_count = max(workers * oversubscription,
+        ceil(width * height * bytes_per_pixel / tile_size), 1)
+
+    if square:
+        tile_side = max(1, isqrt(width * height // tile_count))
+        return square_boxes(width, height, tile_side)
+
+    return band_boxes(width, height, tile_count)
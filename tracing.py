@@ -0,0 +1,162 @@
+"""This module contains the Tracer class and the tracer shared by the whole program.
+
+Code marks its stages with tracer.stage, which records the wall time, bytes moved
+and worker count of the stage into the trace the current thread is running.
+"""
+import cProfile
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Number of finished traces kept in memory
+TRACE_COUNT = 100
+
+class Trace:
+    """This class contains the stages recorded during one operation, such as a build."""
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time.time()
+        self.seconds = None
+        self.stages = []
+        self.notes = {}
+
+    def add(self, stage, seconds, bytes_moved, workers):
+        """Records a finished stage."""
+        self.stages.append({'stage': stage, 'seconds': seconds, 'bytes': bytes_moved,
+            'workers': workers})
+
+    def as_dict(self):
+        """Returns the trace as a dictionary that can be written as JSON."""
+        return {'trace': self.name, 'start_time': self.start_time, 'seconds': self.seconds,
+            'stages': self.stages, 'notes': self.notes}
+
+    def summary(self):
+        """Returns a short description of the time spent in each stage."""
+        # Stages run more than once, such as filter passes, are added up
+        totals = {}
+        for stage in self.stages:
+            totals[stage['stage']] = totals.get(stage['stage'], 0) + stage['seconds']
+
+        summary = f'{self.name.capitalize()} {self.seconds * 1000:.0f} ms'
+        if 'plan' in self.notes:
+            summary += f' ({self.notes["plan"]})'
+        if totals:
+            summary += ': ' + ', '.join(f'{stage} {seconds * 1000:.0f} ms'
+                for stage, seconds in totals.items())
+        return summary
+
+class Tracer:
+    """This class contains the latest traces and writes them to an optional JSON lines log.
+
+    The next trace with a given name can also be profiled with cProfile, the
+    profile only covers the thread running the trace.
+    """
+    def __init__(self):
+        self.traces = deque(maxlen=TRACE_COUNT)
+        self.log_path = None
+        self.profile_path = None
+        self.profile_name = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def open_log(self, log_path):
+        """Appends every finished trace to a JSON lines file."""
+        self.log_path = log_path
+
+    def profile_next(self, profile_path, name):
+        """Profiles the next trace with a name and saves the profile to a path."""
+        with self.lock:
+            self.profile_path = profile_path
+            self.profile_name = name
+
+    @contextmanager
+    def trace(self, name):
+        """Records the stages this thread runs inside the block as one trace."""
+        new_trace = Trace(name)
+        parent = getattr(self.local, 'trace', None)
+        self.local.trace = new_trace
+
+        # Only outermost traces are profiled, profilers can't be nested
+        profile_path = None
+        if parent is None:
+            with self.lock:
+                if self.profile_name == name:
+                    profile_path = self.profile_path
+                    self.profile_path = None
+                    self.profile_name = None
+
+        profile = None
+        if profile_path is not None:
+            profile = cProfile.Profile()
+            profile.enable()
+
+        start_time = time.perf_counter()
+        try:
+            yield new_trace
+        finally:
+            new_trace.seconds = time.perf_counter() - start_time
+            self.local.trace = parent
+
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(profile_path)
+
+            self.finish(new_trace)
+
+    @contextmanager
+    def stage(self, name, bytes_moved=0, workers=1):
+        """Records the wall time of the block as a stage of the current trace.
+
+        Stages run outside of a trace are recorded as a trace of their own.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            current_trace = getattr(self.local, 'trace', None)
+
+            if current_trace is None:
+                current_trace = Trace(name)
+                current_trace.seconds = seconds
+                current_trace.add(name, seconds, bytes_moved, workers)
+                self.finish(current_trace)
+            else:
+                current_trace.add(name, seconds, bytes_moved, workers)
+
+    def note(self, **details):
+        """Records details such as decisions in the current trace.
+
+        Details noted outside of a trace are recorded as a trace of their own.
+        """
+        current_trace = getattr(self.local, 'trace', None)
+        if current_trace is None:
+            current_trace = Trace('note')
+            current_trace.seconds = 0
+            current_trace.notes.update(details)
+            self.finish(current_trace)
+        else:
+            current_trace.notes.update(details)
+
+    def finish(self, finished_trace):
+        """Keeps a finished trace and writes it to the log."""
+        with self.lock:
+            self.traces.append(finished_trace)
+
+            if self.log_path is not None:
+                with open(self.log_path, 'a', encoding='utf-8') as log:
+                    log.write(json.dumps(finished_trace.as_dict()) + '\n')
+
+    def last(self, name):
+        """Returns the latest finished trace with a name, or None."""
+        with self.lock:
+            for finished_trace in reversed(self.traces):
+                if finished_trace.name == name:
+                    return finished_trace
+
+        return None
+
+# Tracer used by every module
+tracer = Tracer()